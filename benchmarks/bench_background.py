@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Vectorized background estimator against the photutils segmentation.
+
+Estimates the background median, rms and source mask of HSC cutouts
+with `utils.photutils_background_iterative` (one image at a time)
+and `utils.fast_background` (a stack of images of the same shape at once),
+and prints their timings and the distribution of their differences:
+median difference relative to the rms, rms ratio, and fraction of the pixels
+whose mask differs.
+
+The cutouts are FITS files as sent by the HSC DAS (the image in the first extension)
+or, if none is given, mock cutouts of random COSMOS positions.
+
+Example:
+    python benchmarks/bench_background.py cutouts/*.fits
+    python benchmarks/bench_background.py -n 100
+"""
+import threading
+import time
+import warnings
+from argparse import ArgumentParser
+
+import numpy as np
+from astropy.io import fits
+
+from hsc_to_lsst import utils
+from hsc_to_lsst.hsc_query import query_hsc
+from hsc_to_lsst.hsc_query.mock_server import MockDasServer
+
+
+def read_cutouts(filenames):
+    images = []
+    for filename in filenames:
+        with fits.open(filename) as hdul:
+            hdu = hdul[1] if len(hdul) > 1 and hdul[1].data is not None else hdul[0]
+            images.append(np.asarray(hdu.data, dtype=float))
+    return images
+
+
+def mock_cutouts(num_objects, size, seed):
+    rng = np.random.default_rng(seed)
+    semaphore = threading.BoundedSemaphore(4)
+    images = []
+    with MockDasServer(seed=seed) as server:
+        server.install()
+        for ra, dec in zip(rng.uniform(149.5, 150.5, num_objects), rng.uniform(1.7, 2.7, num_objects)):
+            hsc_data = query_hsc(ra, dec, semaphore, "mock", "mock", size=size)
+            images += [hsc_data[band]['image'] for band in 'grizy' if hsc_data[band]]
+    return images
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    values = values[np.isfinite(values)]
+    p50, p95, p100 = np.percentile(np.abs(values), [50, 95, 100])
+    return f"{p50:9.2e} {p95:9.2e} {p100:9.2e}"
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("cutouts", nargs="*",
+                        help="FITS files of HSC cutouts")
+    parser.add_argument("--num_objects", "-n", type=int, default=40,
+                        help="Number of objects of the mock cutouts, without files")
+    parser.add_argument("--size", type=float, default=20,
+                        help="Width of the mock cutouts, in arcsec")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    if args.cutouts:
+        images = read_cutouts(args.cutouts)
+    else:
+        images = mock_cutouts(args.num_objects, args.size, args.seed)
+
+    # stacks of the images of the same shape
+    stacks = {}
+    for i, img in enumerate(images):
+        stacks.setdefault(img.shape, []).append(i)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        start = time.perf_counter()
+        reference = [utils.photutils_background_iterative(img) for img in images]
+        t_photutils = time.perf_counter() - start
+
+        fast = [None] * len(images)
+        start = time.perf_counter()
+        for indices in stacks.values():
+            medians, stds, masks = utils.fast_background(np.stack([images[i] for i in indices]))
+            for i, median, std, mask in zip(indices, medians, stds, masks):
+                fast[i] = median, std, mask
+        t_fast = time.perf_counter() - start
+
+    median_diff = [(f[0] - r[0]) / r[1] for f, r in zip(fast, reference)]
+    rms_ratio = [f[1] / r[1] - 1 for f, r in zip(fast, reference)]
+    mask_diff = [np.mean(f[2] != r[2]) for f, r in zip(fast, reference)]
+
+    print(f"{len(images)} images in {len(stacks)} stacks")
+    print(f"photutils: {t_photutils / len(images) * 1e3:.2f} ms/image, "
+          f"fast: {t_fast / len(images) * 1e3:.2f} ms/image, speedup {t_photutils / t_fast:.1f}")
+    print(f"{'|difference|':>24} {'median':>9} {'95%':>9} {'max':>9}")
+    print(f"{'median / rms':>24} {percentiles(median_diff)}")
+    print(f"{'rms ratio - 1':>24} {percentiles(rms_ratio)}")
+    print(f"{'masked pixels differing':>24} {percentiles(mask_diff)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Direct (astropy) against FFT convolution by the PSF-matching kernel.
+
+For each image size and LSST seeing, prints the time of both methods
+and the largest difference between their results.
+
+Example:
+    python benchmarks/bench_convolution.py --sizes 97 121 151 --seeing 0.7 1.0 1.4
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from astropy.convolution import convolve
+
+from hsc_to_lsst.data_degradation import psf
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[97, 121, 151],
+                        help="Widths of the HSC images, in pixels")
+    parser.add_argument("--seeing", type=float, nargs="+", default=[0.7, 0.85, 1.0, 1.2, 1.4],
+                        help="Target FWHM, in arcsec")
+    parser.add_argument("--hsc_fwhm", type=float, default=0.53,
+                        help="FWHM of the HSC images, in arcsec")
+    parser.add_argument("--hsc_pix_scale", type=float, default=0.168,
+                        help="Pixel scale of the HSC images, in arcsec")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Number of convolutions timed")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'size':>5} {'seeing':>6} {'kernel':>7} {'direct ms':>10} {'fft ms':>8} {'fft cold ms':>11} "
+          f"{'speedup':>7} {'max diff':>9}")
+    for size in args.sizes:
+        image = rng.normal(0, 0.05, size=(size, size))
+        y, x = np.mgrid[:size, :size] - size // 2
+        image += np.exp(-(x**2 + y**2) / 50)
+        for seeing in args.seeing:
+            kernel = psf.psf_kernel_from_fhwm_diff(args.hsc_fwhm, seeing, args.hsc_pix_scale)
+            direct = convolve(image, kernel)
+            diff = np.abs(psf.fft_convolve(image, kernel) - direct).max() / np.abs(direct).max()
+
+            t_direct = timeit(lambda: convolve(image, kernel), args.repeat)
+            t_fft = timeit(lambda: psf.fft_convolve(image, kernel), args.repeat)
+
+            def cold():
+                psf._kernel_spectra.clear()
+                psf.fft_convolve(image, kernel)
+
+            t_cold = timeit(cold, args.repeat)
+            print(f"{size:5d} {seeing:6.2f} {kernel.shape[0]:7d} {t_direct * 1e3:10.2f} {t_fft * 1e3:8.2f} "
+                  f"{t_cold * 1e3:11.2f} {t_direct / t_fft:7.1f} {diff:9.1e}")
+
+
+if __name__ == "__main__":
+    main()
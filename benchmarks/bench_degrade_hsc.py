@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput of degrade_hsc against the mock DAS server.
+
+Example:
+    python benchmarks/bench_degrade_hsc.py -n 200 --latency 0.5 --bandwidth 2e6 -- -np 4 -bs 20 --stream
+Arguments after "--" are passed to degrade_hsc.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from astropy.table import Table
+
+from hsc_to_lsst.hsc_query.mock_server import MockDasServer
+
+degrade_hsc = os.path.join(os.path.dirname(__file__), os.pardir, "bin", "degrade_hsc")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--num_objects", "-n", type=int, default=100,
+                        help="Number of objects in the catalog")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Latency of the mock server, in seconds")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="Bandwidth of each response of the mock server, in bytes/s")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="Fraction of requests failing with 503")
+    parser.add_argument("--truncate_rate", type=float, default=0.0,
+                        help="Fraction of responses cut in the middle")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed")
+    parser.add_argument("degrade_hsc_args", nargs="*",
+                        help="Arguments passed to degrade_hsc")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    catalog = Table({
+        "ra": rng.uniform(149.5, 150.5, args.num_objects),
+        "dec": rng.uniform(1.7, 2.7, args.num_objects),
+    })
+
+    env = dict(os.environ, HSC_SSP_CAS_USERNAME="mock", HSC_SSP_CAS_PASSWORD="mock")
+    with tempfile.TemporaryDirectory() as tmpdir, MockDasServer(
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            error_rate=args.error_rate,
+            truncate_rate=args.truncate_rate,
+            seed=args.seed) as server:
+        input_table = os.path.join(tmpdir, "catalog.fits")
+        catalog.write(input_table)
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, degrade_hsc, input_table,
+             "--hsc_api_url", server.cutout_url,
+             "--hsc_psf_api_url", server.psf_url,
+             *args.degrade_hsc_args],
+            env=env,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+
+    print(f"{args.num_objects} objects in {elapsed:.1f} s: {args.num_objects / elapsed:.2f} objects/s")
+    print(f"Server: {server.num_requests} requests, {server.num_items} cutouts, {server.num_bytes / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Separable resampling against reproject_adaptive (with conserve_flux=True).
+
+For each image size and source, prints the time of both methods,
+the total flux of each relative to the input, the largest difference
+between their results relative to the peak of the reference,
+the ratio of the rms of the two results in a pure-noise image (which the Gaussian
+sampling kernel of reproject_adaptive smooths),
+and the shift between the centroids of the two results.
+Pixels within `--drop_edge` pixels of the edges, which reproject leaves NaN, are not compared.
+
+Before that, `check` asserts, for each size, that `overlap_matrix` conserves the flux
+and that `separable_resample` is within `--tolerance` of `resample_with_wcs` on a smooth image;
+the script fails if not.
+
+Example:
+    python benchmarks/bench_resample.py --sizes 97 107 121 --repeat 20
+    python benchmarks/bench_resample.py --check_only
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from hsc_to_lsst.data_degradation.resample import (overlap_matrix, resample_image, resample_wcs,
+                                                   resample_with_wcs, separable_resample)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def sources(size, rng):
+    y, x = np.mgrid[:size, :size] - (size - 1) / 2
+    r = np.hypot(x, y)
+    # HSC seeing of 0.6" is a Gaussian of sigma 1.5 pixels
+    yield "star", np.exp(-r**2 / (2 * 1.5**2))
+    yield "star+0.3", np.exp(-((x - 0.3)**2 + (y + 0.3)**2) / (2 * 1.5**2))
+    yield "disk", np.exp(-np.hypot(x, 2 * y) / 6)
+    yield "noise", rng.normal(0, 1, size=(size, size))
+
+
+def centroid(img):
+    y, x = np.indices(img.shape)
+    return np.array([(img * y).sum(), (img * x).sum()]) / img.sum()
+
+
+def check(size, hsc_pix_scale, lsst_pix_scale, tolerance, smooth_sigma=6.0):
+    """
+    Assert that the resampling matrix of an axis of `size` pixels conserves the flux:
+    each input pixel inside the output grid is shared out entirely (its column sums to 1),
+    and each output pixel gathers the ratio of the pixel sizes (its row sums to it),
+    so that a 2-D image is scaled by the ratio of the pixel areas.
+    Then assert that `separable_resample` is within `tolerance` (relative to the peak)
+    of `resample_with_wcs` on a Gaussian of sigma `smooth_sigma` HSC pixels.
+    """
+    weights = overlap_matrix(size, hsc_pix_scale, lsst_pix_scale)
+    ratio = lsst_pix_scale / hsc_pix_scale
+    # input pixels entirely inside the output grid
+    edges = (np.array([-0.5, weights.shape[0] - 0.5]) + 1 - weights.shape[0] / 2) * ratio + size / 2 - 1
+    inside = (np.arange(size) - 0.5 >= edges[0]) & (np.arange(size) + 0.5 <= edges[1])
+    if not np.allclose(weights.sum(axis=0)[inside], 1, rtol=0, atol=1e-12):
+        raise AssertionError(f"size {size}: input pixels not shared out entirely")
+    if not np.allclose(weights.sum(axis=1), ratio, rtol=1e-12, atol=0):
+        raise AssertionError(f"size {size}: output pixels do not gather the ratio of the pixel sizes")
+
+    y, x = np.mgrid[:size, :size] - (size - 1) / 2
+    image = np.exp(-(x**2 + y**2) / (2 * smooth_sigma**2))
+    img_wcs, lsst_wcs, lsst_shape = resample_wcs(image.shape, hsc_pix_scale, lsst_pix_scale)
+    reference = resample_with_wcs(image, img_wcs, lsst_wcs, lsst_shape, drop_edge=0)
+    separable = separable_resample(image, hsc_pix_scale, lsst_pix_scale)
+    diff = np.nanmax(np.abs(separable - reference)) / np.nanmax(reference)
+    if not diff <= tolerance:
+        raise AssertionError(f"size {size}: separable resampling {diff:.1e} from reproject_adaptive, "
+                             f"more than {tolerance:.1e}")
+    return diff
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[97, 107, 121],
+                        help="Widths of the HSC images, in pixels")
+    parser.add_argument("--hsc_pix_scale", type=float, default=0.168,
+                        help="Pixel scale of the HSC images, in arcsec")
+    parser.add_argument("--lsst_pix_scale", type=float, default=0.2,
+                        help="Pixel scale of the LSST images, in arcsec")
+    parser.add_argument("--drop_edge", type=int, default=5,
+                        help="Number of edge pixels of the output not compared")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Number of resamplings timed")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="Largest difference from reproject_adaptive on a smooth image, relative to its peak")
+    parser.add_argument("--check_only", action="store_true",
+                        help="Only run the checks")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        diff = check(size, args.hsc_pix_scale, args.lsst_pix_scale, args.tolerance)
+        print(f"size {size}: flux conserved, {diff:.1e} from reproject_adaptive on a smooth image")
+    if args.check_only:
+        return
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'size':>5} {'source':>9} {'reproject ms':>12} {'separable ms':>12} {'speedup':>7} "
+          f"{'flux rp':>8} {'flux sep':>8} {'max diff':>9} {'rms ratio':>9} {'shift px':>8}")
+    for size in args.sizes:
+        for name, image in sources(size, rng):
+            def run(method):
+                return resample_image(image, args.hsc_pix_scale, args.lsst_pix_scale,
+                                      drop_edge=args.drop_edge, method=method)
+
+            reference = run("reproject")
+            separable = run("separable")
+            diff = separable - reference
+            if name == "noise":
+                flux_rp = flux_sep = max_diff = shift = np.nan
+                rms_ratio = np.std(separable) / np.nanstd(reference)
+            else:
+                flux_rp = np.nansum(reference) / image.sum()
+                flux_sep = separable.sum() / image.sum()
+                max_diff = np.nanmax(np.abs(diff)) / np.nanmax(reference)
+                rms_ratio = np.nan
+                shift = np.hypot(*(centroid(separable) - centroid(np.nan_to_num(reference))))
+
+            t_rp = timeit(lambda: run("reproject"), args.repeat)
+            t_sep = timeit(lambda: run("separable"), args.repeat)
+            print(f"{size:5d} {name:>9} {t_rp * 1e3:12.2f} {t_sep * 1e3:12.3f} {t_rp / t_sep:7.0f} "
+                  f"{flux_rp:8.4f} {flux_sep:8.4f} {max_diff:9.1e} {rms_ratio:9.2f} {shift:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
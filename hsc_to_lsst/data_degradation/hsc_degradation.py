@@ -1,8 +1,7 @@
-from astropy.nddata import Cutout2D
 from lenstronomy.SimulationAPI.ObservationConfig.LSST import LSST
-from hsc_to_lsst.data_degradation.psf import degrade_psf
-from hsc_to_lsst.data_degradation.resample import resample_image
-from hsc_to_lsst.data_degradation.noise import add_noise
+from hsc_to_lsst.data_degradation.psf import psf_kernel_half_width
+from hsc_to_lsst.data_degradation.plan import get_plan
+import numpy as np
 
 
 def hsc_to_lsst(
@@ -22,49 +21,65 @@ def hsc_to_lsst(
         add_background_noise=True,
         use_nise_diff=True,
         to_adu=False,
-        out_size=64
+        out_size=64,
+        source_mask=None,
+        convolution_method=None,
+        degradation_method=None,
+        resample_method=None,
+        crop_input=True
 ):
+    # the plan of these arguments is built once (see `plan.get_plan`)
+    plan = get_plan(lsst_band,
+                    hsc_img.shape,
+                    out_size,
+                    hsc_fwhm=hsc_fwhm,
+                    hsc_pix_scale=hsc_pix_scale,
+                    psf_transform=psf_transform,
+                    add_poisson_noise=add_poisson_noise,
+                    add_background_noise=add_background_noise,
+                    use_nise_diff=use_nise_diff,
+                    to_adu=to_adu,
+                    convolution_method=convolution_method,
+                    degradation_method=degradation_method,
+                    resample_method=resample_method,
+                    crop_input=crop_input)
+    conditions = {
+        'exp_time': exp_time,
+        'zero_point': lsst_zero_point,
+        'seeing': lsst_fwhm,
+        'rms': background_noise,
+        'median': background_median,
+    }
+    return plan.apply(hsc_img, conditions, hsc_psf=hsc_psf, lsst_psf=lsst_psf, source_mask=source_mask)
+
+
+def min_hsc_size(
+        out_size,
+        lsst_band,
+        hsc_fwhm=0.6,
+        hsc_pix_scale=0.168,
+        lsst_fwhm=None,
+        psf_transform=True,
+        margin=0.5
+):
+    """
+    Width, in arcsec, of the smallest HSC image from which `hsc_to_lsst`
+    makes an `out_size` image that is not affected by the edges of the HSC image:
+    the output, plus the half width of the PSF-matching kernel (whose edges are zero padded)
+    and `margin` arcsec on each side, for the resampling, the rounding of the center
+    of the cutout and the estimation of the background.
+    A cutout of this width has `2 * round(width / 2 / hsc_pix_scale) + 1` pixels.
+    """
     lsst_band_props = LSST(band=lsst_band).kwargs_single_band()
     if lsst_fwhm is None:
         lsst_fwhm = lsst_band_props['seeing']
     lsst_pix_scale = lsst_band_props['pixel_scale']
-    # PSF
+    size = out_size * lsst_pix_scale + 2 * margin
     if psf_transform:
-        hsc_img_conv = degrade_psf(
-                hsc_img,
-                original_fwhm=hsc_fwhm,
-                target_fwhm=lsst_fwhm,
-                original_psf=hsc_psf,
-                target_psf=lsst_psf,
-                original_pix_scale=hsc_pix_scale,
-                target_pix_scale=lsst_pix_scale,
-                max_iters=3,
-                thresh=0.01
-            )
-    else:
-        hsc_img_conv = hsc_img
-
-    # resampling
-    hsc_img_conv_scaled = resample_image(hsc_img_conv, hsc_pix_scale, lsst_pix_scale, drop_edge=0)
-    # cut to out size, centered
-    cy = (hsc_img_conv_scaled.shape[0] - 1) / 2
-    cx = (hsc_img_conv_scaled.shape[1] - 1) / 2
-    hsc_img_conv_scaled = Cutout2D(hsc_img_conv_scaled, (cy, cx), (out_size, out_size)).data
-    # noise
-    if add_poisson_noise or add_background_noise:
-        hsc_img_conv_scaled_noise = add_noise(hsc_img_conv_scaled,
-                                              lsst_band_props,
-                                              exp_time,
-                                              lsst_zero_point,
-                                              background_noise=background_noise,
-                                              background_median=background_median,
-                                              add_poisson_noise=add_poisson_noise,
-                                              add_background_noise=add_background_noise,
-                                              use_nise_diff=use_nise_diff
-                                              )
-    else:
-        hsc_img_conv_scaled_noise = hsc_img_conv_scaled
-    if to_adu:
-        hsc_img_conv_scaled_noise /= lsst_band_props['ccd_gain']
-
-    return hsc_img_conv_scaled_noise
+        size += 2 * psf_kernel_half_width(hsc_fwhm, lsst_fwhm, hsc_pix_scale) * hsc_pix_scale
+    half_pix = int(np.ceil(size / 2 / hsc_pix_scale))
+    # the output is cut out of the center of the resampled image,
+    # half a pixel off unless both have the same parity
+    while ((2 * half_pix + 1) * hsc_pix_scale // lsst_pix_scale) % 2 != out_size % 2:
+        half_pix += 1
+    return 2 * half_pix * hsc_pix_scale
@@ -0,0 +1,90 @@
+from astropy.convolution import Gaussian2DKernel
+from hsc_to_lsst.data_degradation.psf import convolve_kernel
+from hsc_to_lsst.data_degradation.resample import resample_wcs, resample_with_wcs, center_slices
+import functools
+import numpy as np
+
+
+def kernel_sigma(kernel):
+    # standard deviation, in pixels, of a circular Gaussian kernel (0 for no kernel),
+    # None if the kernel is not separable that way
+    if kernel is None:
+        return 0.0
+    model = getattr(kernel, 'model', None)
+    if not isinstance(kernel, Gaussian2DKernel) or model is None:
+        return None
+    if model.x_stddev.value != model.y_stddev.value or model.theta.value % np.pi != 0:
+        return None
+    return float(model.x_stddev.value)
+
+
+class SeparableOperator:
+    """
+    PSF matching by a circular Gaussian kernel (`psf.convolve_kernel`), resampling
+    (`resample.resample_with_wcs`) and centered cutout of `DegradationPlan`, as a pair of matrices:
+    an image is degraded to `a_y @ image @ a_x.T`.
+    The three steps are linear and, for such a kernel and grids that differ only by their pixel scale,
+    act on each axis independently, so the matrices are tabulated by degrading impulses:
+    one per row, in the central column, and one per column, in the central row.
+    The output pixels that `reproject_adaptive` leaves NaN (on the edges of the resampled grid)
+    are NaN too.
+    """
+
+    def __init__(self, input_shape, sigma, original_pix_scale=0.168, lsst_pix_scale=0.2, out_size=64,
+                 convolution_method=None):
+        self.input_shape = tuple(input_shape)
+        self.sigma = sigma
+        kernel = Gaussian2DKernel(x_stddev=sigma) if sigma > 0 else None
+        img_wcs, lsst_wcs, lsst_shape = resample_wcs(self.input_shape, original_pix_scale, lsst_pix_scale)
+        # cut to out size, centered, as in `DegradationPlan`
+        out_slices = center_slices(lsst_shape, out_size)
+
+        def degrade(ys, xs):
+            # responses to the impulses at (ys[k], xs[k])
+            impulses = np.zeros((len(ys),) + self.input_shape)
+            if kernel is None:
+                impulses[np.arange(len(ys)), ys, xs] = 1
+            else:
+                # impulses farther apart than the kernel are convolved together, then cut apart
+                half_y, half_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+                step = max(kernel.shape)
+                for start in range(min(step, len(ys))):
+                    comb = np.zeros(self.input_shape)
+                    comb[ys[start::step], xs[start::step]] = 1
+                    conv = convolve_kernel(comb, kernel, convolution_method)
+                    for k in range(start, len(ys), step):
+                        window = (slice(max(ys[k] - half_y, 0), ys[k] + half_y + 1),
+                                  slice(max(xs[k] - half_x, 0), xs[k] + half_x + 1))
+                        impulses[k][window] = conv[window]
+            return resample_with_wcs(impulses, img_wcs, lsst_wcs, lsst_shape, drop_edge=0)[(Ellipsis,) + out_slices]
+
+        ny, nx = self.input_shape
+        cy, cx = ny // 2, nx // 2
+        # the response to the impulse at (i, cx) is a_y[:, i] * a_x[:, cx], that at (cy, j) a_y[:, cy] * a_x[:, j]
+        column_responses = degrade(np.arange(ny), np.full(ny, cx))
+        row_responses = degrade(np.full(nx, cy), np.arange(nx))
+        center = column_responses[cy]
+        r0 = np.unravel_index(np.nanargmax(np.abs(center)), center.shape)[0]
+        # the pair is defined up to a factor: a_x[:, cx] is taken as the row r0 of the central response
+        weights = center[r0]
+        good = np.isfinite(weights)
+        self.a_y = (column_responses[:, :, good] @ weights[good]).T / (weights[good] @ weights[good])
+        self.a_x = row_responses[:, r0, :].T
+
+    def apply(self, images):
+        # an image of `input_shape`, or a stack of them of shape (N, ny, nx)
+        images = np.asarray(images, dtype=float)
+        if images.shape[-2:] != self.input_shape:
+            raise ValueError(f"Images of shape {images.shape} for an operator on {self.input_shape}")
+        return self.a_y @ images @ self.a_x.T
+
+
+@functools.lru_cache(maxsize=256)
+def get_operator(input_shape, sigma, original_pix_scale=0.168, lsst_pix_scale=0.2, out_size=64,
+                 convolution_method=None):
+    """
+    Operator for these arguments (see `SeparableOperator`), built the first time it is asked for.
+    With a `psf.KernelCache`, the kernels of close seeing share their sigma, so their operator.
+    """
+    return SeparableOperator(input_shape, sigma, original_pix_scale, lsst_pix_scale, out_size,
+                             convolution_method)
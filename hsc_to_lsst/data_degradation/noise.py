@@ -1,4 +1,5 @@
-from hsc_to_lsst.utils import photutils_background_iterative
+from hsc_to_lsst.utils import background_iterative
+from astropy.stats import sigma_clipped_stats
 from lenstronomy.Util import data_util
 import numpy as np
 # import warnings
@@ -13,8 +14,11 @@ def add_noise(img,
               add_poisson_noise=True,
               add_background_noise=True,
               use_nise_diff=True,
+              source_mask=None,
               ):
-    img_median, img_std, _ = photutils_background_iterative(img)
+    # with a source mask (e.g. from the HSC mask plane, see `resample.resample_mask`),
+    # the background is estimated without detecting the sources again
+    img_median, img_std = _background(img, source_mask)
     img = img - img_median
 
     num_exposures = exp_time / 15
@@ -53,7 +57,14 @@ def add_noise(img,
             # warnings.warn("Warning: original noise is larger than target")
             raise ValueError("Background noise is larger than target")
 
-    img_median = photutils_background_iterative(img)[0]
+    img_median = _background(img, source_mask)[0]
     img += background_median - img_median
 
     return img
+
+
+def _background(img, source_mask=None):
+    if source_mask is None:
+        return background_iterative(img)[:2]
+    _, median, std = sigma_clipped_stats(img, sigma=3, mask=source_mask, maxiters=10)
+    return median, std
@@ -0,0 +1,248 @@
+from lenstronomy.SimulationAPI.ObservationConfig.LSST import LSST
+from lenstronomy.Util import data_util
+from hsc_to_lsst.data_degradation.psf import psf_matching_kernel, convolve_kernel
+from hsc_to_lsst.data_degradation.linear_operator import kernel_sigma, get_operator
+from hsc_to_lsst.data_degradation import psf, resample
+from hsc_to_lsst.data_degradation.resample import (resample_wcs, resample_with_wcs, separable_resample, resample_mask,
+                                                   center_slices)
+from hsc_to_lsst.data_degradation.noise import add_noise
+import functools
+import numpy as np
+
+
+# "reproject" (convolution, then `reproject_adaptive`) or "linear" (`linear_operator.SeparableOperator`)
+default_degradation_method = "reproject"
+
+
+class DegradationPlan:
+    """
+    What `hsc_degradation.hsc_to_lsst` computes for a band, shapes and pixel scales,
+    computed once to degrade many images with `apply`.
+    The LSST band properties, the resampling WCS, the slices of the output cutout
+    and the default background noise (for each zero point and exposure time) are kept.
+    With `crop_input`, the images are first cropped, symmetrically, to what the output needs
+    (see `crop_shape`), so the work does not grow with the size of the HSC cutouts.
+    """
+
+    def __init__(
+            self,
+            lsst_band,
+            input_shape,
+            out_size=64,
+            hsc_fwhm=0.6,
+            hsc_pix_scale=0.168,
+            psf_transform=True,
+            add_poisson_noise=True,
+            add_background_noise=True,
+            use_nise_diff=True,
+            to_adu=False,
+            convolution_method=None,
+            degradation_method=None,
+            resample_method=None,
+            crop_input=True,
+            crop_margin=0.5
+    ):
+        self.lsst_band = lsst_band
+        self.input_shape = tuple(input_shape)
+        self.out_size = out_size
+        self.hsc_fwhm = hsc_fwhm
+        self.hsc_pix_scale = hsc_pix_scale
+        self.psf_transform = psf_transform
+        self.add_poisson_noise = add_poisson_noise
+        self.add_background_noise = add_background_noise
+        self.use_nise_diff = use_nise_diff
+        self.to_adu = to_adu
+        # see `psf.degrade_psf`
+        self.convolution_method = convolution_method or psf.default_convolution_method
+        # see `default_degradation_method`
+        self.degradation_method = degradation_method or default_degradation_method
+        if self.degradation_method not in ("reproject", "linear"):
+            raise ValueError(f"Unknown degradation method: {self.degradation_method}")
+        # see `resample.resample_image`
+        self.resample_method = resample_method or resample.default_resample_method
+        if self.resample_method not in ("reproject", "separable"):
+            raise ValueError(f"Unknown resampling method: {self.resample_method}")
+        self.crop_input = crop_input
+        # arcsec kept around the output and the kernel, for the edges of the resampling
+        self.crop_margin = crop_margin
+
+        self.lsst_band_props = LSST(band=lsst_band).kwargs_single_band()
+        self.lsst_pix_scale = self.lsst_band_props['pixel_scale']
+        self._grids = {}
+        self.img_wcs, self.lsst_wcs, self.lsst_shape, self.out_slices = self.grid(self.input_shape)
+        self._background_noise = {}
+
+    def grid(self, shape):
+        # resampling WCS, resampled shape and slices of the output cutout of an image of `shape`
+        if shape not in self._grids:
+            img_wcs, lsst_wcs, lsst_shape = resample_wcs(shape, self.hsc_pix_scale, self.lsst_pix_scale)
+            # cut to out size, centered
+            out_slices = center_slices(lsst_shape, self.out_size)
+            self._grids[shape] = img_wcs, lsst_wcs, lsst_shape, out_slices
+        return self._grids[shape]
+
+    def crop_shape(self, kernel_half_width=0):
+        """
+        Shape of the centered crop of the input images that the output needs: the output,
+        plus `kernel_half_width` HSC pixels and `crop_margin` on each side.
+        Each axis is cropped by an even number of pixels, to a size that resamples to one of the same parity,
+        so the crop has the same center, and its resampled grid the same pixels
+        and output cutout (see `resample.center_slices`), as the whole image.
+        The output then does not change, except that `reproject_adaptive` breaks the ties
+        between input pixels on the edge of its sampling region by rounding,
+        which for some even shapes changes a few output pixels by up to about 1e-4 of the peak.
+        """
+        min_size = int(np.ceil((self.out_size * self.lsst_pix_scale + 2 * self.crop_margin) / self.hsc_pix_scale))
+        min_size += 2 * kernel_half_width
+        shape = []
+        for size in self.input_shape:
+            lsst_size = int(size * self.hsc_pix_scale // self.lsst_pix_scale)
+            crop = min_size + (size - min_size) % 2
+            while crop < size and int(crop * self.hsc_pix_scale // self.lsst_pix_scale) % 2 != lsst_size % 2:
+                crop += 2
+            shape.append(min(crop, size))
+        return tuple(shape)
+
+    def default_background_noise(self, zero_point, exp_time):
+        # background noise of lenstronomy's LSST sky, as computed by `noise.add_noise`
+        key = (zero_point, exp_time)
+        if key not in self._background_noise:
+            sky_brightness_cps = data_util.magnitude2cps(
+                    self.lsst_band_props['sky_brightness'],
+                    magnitude_zero_point=zero_point,
+                )
+            self._background_noise[key] = data_util.bkg_noise(
+                    self.lsst_band_props['read_noise'],
+                    15,
+                    sky_brightness_cps,
+                    self.lsst_band_props['pixel_scale'],
+                    exp_time / 15,
+                )
+        return self._background_noise[key]
+
+    def operator(self, lsst_fwhm=None, hsc_psf=None, lsst_psf=None):
+        """
+        PSF matching, resampling and cutout for this seeing, as a `linear_operator.SeparableOperator`,
+        which degrades a whole stack of images at once (without noise);
+        None if the PSF-matching kernel is not separable.
+        """
+        if lsst_fwhm is None:
+            lsst_fwhm = self.lsst_band_props['seeing']
+        return self._operator(self.input_shape, self.kernel(lsst_fwhm, hsc_psf, lsst_psf))
+
+    def _operator(self, shape, kernel):
+        sigma = kernel_sigma(kernel)
+        if sigma is None:
+            return None
+        return get_operator(shape, sigma, self.hsc_pix_scale, self.lsst_pix_scale, self.out_size,
+                            self.convolution_method)
+
+    def kernel(self, lsst_fwhm, hsc_psf=None, lsst_psf=None):
+        # PSF-matching kernel (see `psf.psf_matching_kernel`), None if there is no convolution
+        kernel = None
+        if self.psf_transform:
+            kernel = psf_matching_kernel(
+                    original_fwhm=self.hsc_fwhm,
+                    target_fwhm=lsst_fwhm,
+                    original_psf=hsc_psf,
+                    target_psf=lsst_psf,
+                    original_pix_scale=self.hsc_pix_scale,
+                    target_pix_scale=self.lsst_pix_scale,
+                    max_iters=3,
+                    thresh=0.01
+                )
+        return kernel
+
+    def _convolve_and_resample(self, image, kernel):
+        # PSF
+        if kernel is not None:
+            img_conv = convolve_kernel(image, kernel, self.convolution_method)
+        else:
+            img_conv = image
+
+        # resampling
+        img_wcs, lsst_wcs, lsst_shape, out_slices = self.grid(image.shape)
+        if self.resample_method == "separable":
+            img_scaled = separable_resample(img_conv, self.hsc_pix_scale, self.lsst_pix_scale)
+        else:
+            img_scaled = resample_with_wcs(img_conv, img_wcs, lsst_wcs, lsst_shape, drop_edge=0)
+        return img_scaled[out_slices]
+
+    def apply(self, image, conditions=None, hsc_psf=None, lsst_psf=None, source_mask=None):
+        """
+        Degrade an image of shape `input_shape`.
+        `conditions` has the keys of the DP0 samples ('exp_time', 'zero_point', 'seeing',
+        'rms' and 'median'), the missing ones taking the defaults of `hsc_to_lsst`.
+        """
+        if image.shape != self.input_shape:
+            raise ValueError(f"Image of shape {image.shape} in a plan for {self.input_shape}")
+        if conditions is None:
+            conditions = {}
+        exp_time = conditions.get('exp_time', 30.0)
+        zero_point = conditions.get('zero_point', 31.0)
+        lsst_fwhm = conditions.get('seeing')
+        if lsst_fwhm is None:
+            lsst_fwhm = self.lsst_band_props['seeing']
+        background_noise = conditions.get('rms')
+        background_median = conditions.get('median', 0)
+
+        kernel = self.kernel(lsst_fwhm, hsc_psf, lsst_psf)
+        if self.crop_input:
+            half_width = 0 if kernel is None else max(kernel.shape) // 2
+            ny, nx = self.crop_shape(half_width)
+            y0 = (image.shape[0] - ny) // 2
+            x0 = (image.shape[1] - nx) // 2
+            image = image[y0:y0 + ny, x0:x0 + nx]
+            if source_mask is not None:
+                source_mask = source_mask[y0:y0 + ny, x0:x0 + nx]
+
+        operator = None
+        if self.degradation_method == "linear" and np.isfinite(image).all():
+            operator = self._operator(image.shape, kernel)
+
+        if operator is not None:
+            img_scaled = operator.apply(image)
+        else:
+            img_scaled = self._convolve_and_resample(image, kernel)
+        if source_mask is not None:
+            out_slices = self.grid(image.shape)[3]
+            source_mask = resample_mask(source_mask, self.hsc_pix_scale, self.lsst_pix_scale)[out_slices]
+
+        # noise
+        if self.add_poisson_noise or self.add_background_noise:
+            if background_noise is None and self.add_background_noise:
+                background_noise = self.default_background_noise(zero_point, exp_time)
+            img_scaled = add_noise(img_scaled,
+                                   self.lsst_band_props,
+                                   exp_time,
+                                   zero_point,
+                                   background_noise=background_noise,
+                                   background_median=background_median,
+                                   add_poisson_noise=self.add_poisson_noise,
+                                   add_background_noise=self.add_background_noise,
+                                   use_nise_diff=self.use_nise_diff,
+                                   source_mask=source_mask
+                                   )
+        if self.to_adu:
+            img_scaled /= self.lsst_band_props['ccd_gain']
+
+        return img_scaled
+
+
+def get_plan(lsst_band, input_shape, out_size=64, hsc_fwhm=0.6, hsc_pix_scale=0.168,
+             convolution_method=None, degradation_method=None, resample_method=None, **kwargs):
+    """
+    Plan for these arguments (see `DegradationPlan`), built the first time it is asked for.
+    The methods left to their module defaults are resolved first, so that a plan built
+    before a default changed is not reused after.
+    """
+    return _get_plan(lsst_band, input_shape, out_size, hsc_fwhm, hsc_pix_scale,
+                     convolution_method=convolution_method or psf.default_convolution_method,
+                     degradation_method=degradation_method or default_degradation_method,
+                     resample_method=resample_method or resample.default_resample_method,
+                     **kwargs)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_plan(lsst_band, input_shape, out_size, hsc_fwhm, hsc_pix_scale, **kwargs):
+    return DegradationPlan(lsst_band, input_shape, out_size, hsc_fwhm, hsc_pix_scale, **kwargs)
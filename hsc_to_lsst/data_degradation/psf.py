@@ -1,11 +1,23 @@
+import collections
+import multiprocessing
 import numpy as np
 from astropy.convolution import Gaussian2DKernel
 from astropy.stats import gaussian_fwhm_to_sigma
 from hsc_to_lsst.utils import get_fwhm
 from astropy.convolution import convolve
+from scipy import fft
 import warnings
 
 
+# "direct" (astropy's convolve) or "fft" (`fft_convolve`), for `degrade_psf`
+default_convolution_method = "direct"
+# number of kernel spectra kept by `fft_convolve`
+max_cached_spectra = 64
+_kernel_spectra = collections.OrderedDict()
+# `KernelCache` used by `degrade_psf`, none by default
+default_kernel_cache = None
+
+
 def psf_kernel_from_fhwm(fwhm, pix_scale):
     kernel_sigma = fwhm * gaussian_fwhm_to_sigma / pix_scale
     kernel = Gaussian2DKernel(x_stddev=kernel_sigma)
@@ -17,6 +29,16 @@ def psf_kernel_from_fhwm_diff(original_fwhm, target_fwhm, original_pix_scale):
     return psf_kernel_from_fhwm(trans_fwhm, original_pix_scale)
 
 
+def psf_kernel_half_width(original_fwhm, target_fwhm, original_pix_scale):
+    # half width, in pixels, of the kernel made by `psf_kernel_from_fhwm_diff`
+    # (`Gaussian2DKernel` is 8 sigma wide), 0 if no convolution is needed
+    if original_fwhm >= target_fwhm:
+        return 0
+    trans_fwhm = np.sqrt(target_fwhm**2 - original_fwhm**2)
+    kernel_sigma = trans_fwhm * gaussian_fwhm_to_sigma / original_pix_scale
+    return int(np.ceil(4 * kernel_sigma))
+
+
 def iterative_psf_transform_kernel(original_psf, target_fwhm,
                                    original_pix_scale,
                                    max_iters=3, thresh=0.01):
@@ -33,8 +55,140 @@ def iterative_psf_transform_kernel(original_psf, target_fwhm,
     return trans_kernel
 
 
-def degrade_psf(
-        image,
+class KernelCache:
+    """
+    LRU cache of PSF-matching kernels, and of the FWHM of PSFs.
+
+    The target FWHM is rounded to a multiple of `fwhm_tolerance` (in arcsec),
+    so that objects with close seeing share their kernels;
+    the original PSF is identified by its FWHM, or its values if it is an image.
+    The kernels are kept by each process, but the hits and misses are counted
+    for all the processes that inherit the cache from its creator.
+    """
+
+    def __init__(self, max_size=256, fwhm_tolerance=0.005):
+        self.max_size = max_size
+        self.fwhm_tolerance = fwhm_tolerance
+        self._items = collections.OrderedDict()
+        self._hits = multiprocessing.Value("q", 0)
+        self._misses = multiprocessing.Value("q", 0)
+
+    @property
+    def hits(self):
+        return self._hits.value
+
+    @property
+    def misses(self):
+        return self._misses.value
+
+    def quantize(self, fwhm):
+        if not self.fwhm_tolerance:
+            return fwhm
+        return round(fwhm / self.fwhm_tolerance) * self.fwhm_tolerance
+
+    def _get(self, key, make):
+        item = self._items.get(key)
+        if item is not None:
+            with self._hits.get_lock():
+                self._hits.value += 1
+            self._items.move_to_end(key)
+            return item
+        with self._misses.get_lock():
+            self._misses.value += 1
+        item = make()
+        self._items[key] = item
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return item
+
+    def psf_fwhm(self, psf, pix_scale):
+        # `get_fwhm`
+        key = ('fwhm', psf.shape, hash(psf.tobytes()), pix_scale)
+        return self._get(key, lambda: get_fwhm(psf, pix_scale))
+
+    def kernel(self, original_fwhm, target_fwhm, original_pix_scale):
+        # `psf_kernel_from_fhwm_diff` for the quantized `target_fwhm`
+        target_fwhm = self.quantize(target_fwhm)
+        key = ('fwhm_diff', original_fwhm, target_fwhm, original_pix_scale)
+        return self._get(key, lambda: psf_kernel_from_fhwm_diff(original_fwhm, target_fwhm, original_pix_scale))
+
+    def iterative_kernel(self, original_psf, target_fwhm, original_pix_scale, max_iters=3, thresh=0.01):
+        # `iterative_psf_transform_kernel` for the quantized `target_fwhm`
+        target_fwhm = self.quantize(target_fwhm)
+        key = ('iterative', original_psf.shape, hash(original_psf.tobytes()), target_fwhm, original_pix_scale,
+               max_iters, thresh)
+        return self._get(key, lambda: iterative_psf_transform_kernel(original_psf, target_fwhm, original_pix_scale,
+                                                                     max_iters, thresh))
+
+    def stats(self):
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'size': len(self._items),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        self._items.clear()
+        self._hits.value = 0
+        self._misses.value = 0
+
+
+def _kernel_key(kernel):
+    # Gaussian kernels are identified by their width, others by their values
+    model = getattr(kernel, 'model', None)
+    if isinstance(kernel, Gaussian2DKernel) and model is not None:
+        return 'gaussian', kernel.shape, float(model.x_stddev.value), float(model.y_stddev.value)
+    array = np.asarray(getattr(kernel, 'array', kernel))
+    return 'array', array.shape, hash(array.tobytes())
+
+
+def _kernel_spectrum(kernel, fshape):
+    key = (fshape,) + _kernel_key(kernel)
+    spectrum = _kernel_spectra.get(key)
+    if spectrum is not None:
+        _kernel_spectra.move_to_end(key)
+        return spectrum
+    array = np.asarray(getattr(kernel, 'array', kernel), dtype=float)
+    # same normalization as `convolve(normalize_kernel=True)`
+    spectrum = fft.rfft2(array / array.sum(), fshape)
+    _kernel_spectra[key] = spectrum
+    if len(_kernel_spectra) > max_cached_spectra:
+        _kernel_spectra.popitem(last=False)
+    return spectrum
+
+
+def fft_convolve(image, kernel):
+    """
+    Same as astropy's `convolve(image, kernel)` (zero-filled boundary, normalized kernel)
+    for images without NaN, by real FFTs padded to fast lengths.
+    The spectra of the kernels are cached for each padded shape (see `max_cached_spectra`).
+    """
+    image = np.asarray(image, dtype=float)
+    kernel_shape = np.shape(getattr(kernel, 'array', kernel))
+    # zero padding of the width of the kernel, so that the convolution is not circular
+    full_shape = [n + k - 1 for n, k in zip(image.shape, kernel_shape)]
+    fshape = tuple(fft.next_fast_len(n, real=True) for n in full_shape)
+    conv = fft.irfft2(fft.rfft2(image, fshape) * _kernel_spectrum(kernel, fshape), fshape)
+    y0, x0 = kernel_shape[0] // 2, kernel_shape[1] // 2
+    return conv[y0:y0 + image.shape[0], x0:x0 + image.shape[1]]
+
+
+def convolve_kernel(image, kernel, method=None):
+    # method "direct" or "fft", `default_convolution_method` if None
+    if method is None:
+        method = default_convolution_method
+    if method == "fft" and not np.isnan(image).any():
+        return fft_convolve(image, kernel)
+    elif method in ("direct", "fft"):
+        # astropy interpolates NaNs
+        return convolve(image, kernel)
+    raise ValueError(f"Unknown convolution method: {method}")
+
+
+def psf_matching_kernel(
         original_fwhm=None,
         target_fwhm=None,
         original_psf=None,
@@ -42,19 +196,52 @@ def degrade_psf(
         original_pix_scale=0.168,
         target_pix_scale=0.20,
         max_iters=3,
-        thresh=0.01
+        thresh=0.01,
+        kernel_cache=None
 ):
+    # kernel by which `degrade_psf` convolves, None if the original FWHM is larger than the target
+    # `kernel_cache` is a `KernelCache`, `default_kernel_cache` if None
+    if kernel_cache is None:
+        kernel_cache = default_kernel_cache
     if target_psf is not None:
         target_fwhm = get_fwhm(target_psf, target_pix_scale)
+    if kernel_cache is not None:
+        target_fwhm = kernel_cache.quantize(target_fwhm)
     if original_psf is not None:
-        original_fwhm = get_fwhm(original_psf, original_pix_scale)
-        if original_fwhm > target_fwhm:
-            warnings.warn("Warning: original FWHM is larger than target")
-            return image
-        trans_kernel = iterative_psf_transform_kernel(original_psf, target_fwhm, original_pix_scale, max_iters, thresh)
-    else:
+        if kernel_cache is not None:
+            original_fwhm = kernel_cache.psf_fwhm(original_psf, original_pix_scale)
+        else:
+            original_fwhm = get_fwhm(original_psf, original_pix_scale)
         if original_fwhm > target_fwhm:
             warnings.warn("Warning: original FWHM is larger than target")
-            return image
-        trans_kernel = psf_kernel_from_fhwm_diff(original_fwhm, target_fwhm, original_pix_scale)
-    return convolve(image, trans_kernel)
+            return None
+        if kernel_cache is not None:
+            return kernel_cache.iterative_kernel(original_psf, target_fwhm, original_pix_scale, max_iters, thresh)
+        return iterative_psf_transform_kernel(original_psf, target_fwhm, original_pix_scale, max_iters, thresh)
+    if original_fwhm > target_fwhm:
+        warnings.warn("Warning: original FWHM is larger than target")
+        return None
+    if kernel_cache is not None:
+        return kernel_cache.kernel(original_fwhm, target_fwhm, original_pix_scale)
+    return psf_kernel_from_fhwm_diff(original_fwhm, target_fwhm, original_pix_scale)
+
+
+def degrade_psf(
+        image,
+        original_fwhm=None,
+        target_fwhm=None,
+        original_psf=None,
+        target_psf=None,
+        original_pix_scale=0.168,
+        target_pix_scale=0.20,
+        max_iters=3,
+        thresh=0.01,
+        method=None,
+        kernel_cache=None
+):
+    trans_kernel = psf_matching_kernel(original_fwhm, target_fwhm, original_psf, target_psf,
+                                       original_pix_scale, target_pix_scale, max_iters, thresh, kernel_cache)
+    if trans_kernel is None:
+        return image
+    # method "direct" or "fft", `default_convolution_method` if None
+    return convolve_kernel(image, trans_kernel, method)
@@ -1,20 +1,29 @@
+from astropy.nddata import Cutout2D
 from astropy.wcs import WCS
 from reproject import reproject_adaptive
+from scipy.ndimage import binary_dilation
+from photutils.utils import circular_footprint
+import functools
 import numpy as np
 
 
 deg2arcsec = 3600
+# "reproject" (`reproject_adaptive`) or "separable" (`separable_resample`), for `resample_image`
+default_resample_method = "reproject"
 
 
-def resample_image(img, original_pix_scale, lsst_pix_scale=0.2, drop_edge=5, out_size=None):
+def resample_wcs(shape, original_pix_scale, lsst_pix_scale=0.2, out_size=None):
+    """
+    WCS of an image of `shape` and of its resampling by `resample_image`,
+    and the shape of the latter, which depend only on the shapes and pixel scales.
+    """
     img_wcs = WCS(naxis=2)
     img_wcs.wcs.cd = np.array([[-1, 0],
                                [ 0, 1]]) * original_pix_scale / deg2arcsec
-    img_crpix = np.flip(np.array(img.shape)) / 2
+    img_crpix = np.flip(np.array(shape)) / 2
     img_wcs.wcs.crpix = img_crpix
 
-    img_field = np.array(img.shape) * original_pix_scale
-    img_center = img_wcs.pixel_to_world(*((np.array(img.shape) - 1) / 2))
+    img_field = np.array(shape) * original_pix_scale
 
     if out_size is None:
         lsst_size = img_field // lsst_pix_scale
@@ -27,12 +36,115 @@ def resample_image(img, original_pix_scale, lsst_pix_scale=0.2, drop_edge=5, out
     lsst_wcs.wcs.cd = np.array([[-1, 0],
                                 [ 0, 1]]) * lsst_pix_scale / deg2arcsec
     lsst_wcs.wcs.ctype = img_wcs.wcs.ctype
+    return img_wcs, lsst_wcs, lsst_size.astype(int)
 
+
+def center_slices(shape, out_size):
+    """
+    Slices of the `out_size` x `out_size` cutout at the center of an image of `shape`
+    (`Cutout2D` takes the position as (x, y)).
+    """
+    cy = (shape[0] - 1) / 2
+    cx = (shape[1] - 1) / 2
+    return Cutout2D(np.empty(shape, dtype=bool), (cx, cy), (out_size, out_size)).slices_original
+
+
+def resample_with_wcs(img, img_wcs, lsst_wcs, lsst_shape, drop_edge=5):
     img_scaled, _ = reproject_adaptive((img, img_wcs), lsst_wcs,
-                                       shape_out=lsst_size.astype(int), conserve_flux=True,
+                                       shape_out=lsst_shape, conserve_flux=True,
                                        bad_fill_value=0)
     # drop edge that has bad pixels
     if drop_edge > 0:
         img_scaled = img_scaled[drop_edge:-drop_edge,
                                 drop_edge:-drop_edge]
-    return img_scaled
\ No newline at end of file
+    return img_scaled
+
+
+def resample_image(img, original_pix_scale, lsst_pix_scale=0.2, drop_edge=5, out_size=None, method=None):
+    if method is None:
+        method = default_resample_method
+    if method == "separable":
+        img_scaled = separable_resample(img, original_pix_scale, lsst_pix_scale, out_size)
+        if drop_edge > 0:
+            img_scaled = img_scaled[drop_edge:-drop_edge,
+                                    drop_edge:-drop_edge]
+        return img_scaled
+    if method != "reproject":
+        raise ValueError(f"Unknown resampling method: {method}")
+    img_wcs, lsst_wcs, lsst_shape = resample_wcs(img.shape, original_pix_scale, lsst_pix_scale, out_size)
+    return resample_with_wcs(img, img_wcs, lsst_wcs, lsst_shape, drop_edge)
+
+
+def overlap_matrix(size, original_pix_scale, lsst_pix_scale=0.2, lsst_size=None):
+    """
+    Resampling of an axis of `size` pixels on the grid of `resample_image` (with `drop_edge=0`),
+    as a `(lsst_size, size)` matrix: the fraction of each input pixel that falls in each output pixel,
+    which conserves the flux.
+    """
+    if lsst_size is None:
+        lsst_size = int(size * original_pix_scale // lsst_pix_scale)
+    # edges of the output pixels, in input pixels, with the reference pixels of `resample_wcs`
+    edges = np.arange(lsst_size + 1) - 0.5
+    edges = (edges + 1 - lsst_size / 2) * lsst_pix_scale / original_pix_scale + size / 2 - 1
+    pix = np.arange(size)
+    overlap = (np.minimum(edges[1:, None], pix[None, :] + 0.5)
+               - np.maximum(edges[:-1, None], pix[None, :] - 0.5))
+    return np.clip(overlap, 0, None)
+
+
+@functools.lru_cache(maxsize=64)
+def _overlap_matrices(shape, original_pix_scale, lsst_pix_scale, lsst_shape):
+    return tuple(overlap_matrix(size, original_pix_scale, lsst_pix_scale, lsst_size)
+                 for size, lsst_size in zip(shape, lsst_shape))
+
+
+def separable_resample(img, original_pix_scale, lsst_pix_scale=0.2, out_size=None):
+    """
+    Resample an image on the grid of `resample_image`, the grids differing only by their pixel scale,
+    as two products by the matrices of `overlap_matrix`, which are computed once for each shape and scales.
+    The output pixels that overlap a NaN input pixel are NaN, as with `reproject_adaptive`;
+    those on the edges that are partly out of the input are not, but only get the flux that falls in.
+    """
+    img = np.asarray(img, dtype=float)
+    if out_size is None:
+        lsst_shape = (np.array(img.shape) * original_pix_scale // lsst_pix_scale).astype(int)
+    else:
+        lsst_shape = np.broadcast_to(out_size, (2,)).astype(int)
+    r_y, r_x = _overlap_matrices(img.shape, original_pix_scale, lsst_pix_scale,
+                                  tuple(int(n) for n in lsst_shape))
+    bad = ~np.isfinite(img)
+    if not bad.any():
+        return r_y @ img @ r_x.T
+    img_scaled = r_y @ np.where(bad, 0, img) @ r_x.T
+    img_scaled[(r_y @ bad @ r_x.T) > 0] = np.nan
+    return img_scaled
+
+
+def resample_mask(mask, original_pix_scale, lsst_pix_scale=0.2, dilate_size=2):
+    """
+    Resample a boolean mask on the grid of `resample_image` (with `drop_edge=0` and `out_size=None`).
+    An output pixel is masked if it overlaps any masked input pixel,
+    then the mask is dilated by a disk of radius `dilate_size` output pixels.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    lsst_size = (np.array(mask.shape) * original_pix_scale // lsst_pix_scale).astype(int)
+    # number of masked pixels in mask[:i, :j]
+    counts = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    counts[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0), axis=1)
+
+    ranges = []
+    for axis in range(2):
+        # same reference pixels as the WCS of `resample_image`
+        img_crpix = mask.shape[axis] / 2
+        lsst_crpix = lsst_size[axis] / 2
+        edges = np.arange(lsst_size[axis] + 1) - 0.5
+        edges = (edges + 1 - lsst_crpix) * lsst_pix_scale / original_pix_scale + img_crpix - 1
+        # input pixels overlapping each output pixel, as slices [start, stop)
+        start = np.clip(np.floor(edges[:-1] - 0.5) + 1, 0, mask.shape[axis]).astype(int)
+        stop = np.clip(np.ceil(edges[1:] + 0.5), 0, mask.shape[axis]).astype(int)
+        ranges.append((start, stop))
+    (y0, y1), (x0, x1) = ranges
+    masked = (counts[y1][:, x1] - counts[y0][:, x1] - counts[y1][:, x0] + counts[y0][:, x0]) > 0
+    if dilate_size > 0:
+        masked = binary_dilation(masked, structure=circular_footprint(radius=dilate_size))
+    return masked
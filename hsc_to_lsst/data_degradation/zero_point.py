@@ -1,20 +1,24 @@
-from hsc_to_lsst.utils import photutils_background_iterative
+from hsc_to_lsst.utils import background_iterative
 import numpy as np
 
 
-def zero_point_change(images, original_zero_points, lsst_zero_points, lsst_rms, rms_frac_thresh=0.1):
+def zero_point_change(images, original_zero_points, lsst_zero_points, lsst_rms, rms_frac_thresh=0.1,
+                      original_rms=None):
     """
     Changes the zero point of an image from original to target.
     If the noise allows it, it reaches the target zero point,
     in other case it reaches an intermediate point preserving
     the colors.
+    The background rms of the images is estimated unless `original_rms` is given.
     """
     original_zero_points = np.asarray(original_zero_points)
     lsst_zero_points = np.asarray(lsst_zero_points)
     lsst_rms = np.asarray(lsst_rms)
-    original_rms = np.zeros(len(images))
-    for i, img in enumerate(images):
-        original_rms[i] = photutils_background_iterative(img)[1]
+    if original_rms is None:
+        original_rms = np.zeros(len(images))
+        for i, img in enumerate(images):
+            original_rms[i] = background_iterative(img)[1]
+    original_rms = np.asarray(original_rms)
     max_zp_diff = 2.5 * np.log10(lsst_rms * rms_frac_thresh / original_rms)
     zp_diff = lsst_zero_points - original_zero_points
     if (zp_diff < max_zp_diff).all():
@@ -1,4 +1,4 @@
-from hsc_to_lsst.hsc_query.query import query_hsc
+from hsc_to_lsst.hsc_query.query import query_hsc, query_hsc_batch, iter_query_hsc_batch
 
 
-__all__ = ['query_hsc']
+__all__ = ['query_hsc', 'query_hsc_batch', 'iter_query_hsc_batch']
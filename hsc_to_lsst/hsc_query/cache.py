@@ -0,0 +1,407 @@
+"""
+On-disk cache of the cut-outs and PSFs returned by the DAS server.
+
+Every exploded `Rect` (one filter of one object) is an entry,
+addressed by a hash of the fields that determine the server's response.
+An entry stores the list of `(metadata, data)` returned for the rect,
+which may be empty if the server has no data for it.
+The total size of the cache is kept under `max_bytes`
+by deleting the least recently used entries.
+
+PSFs vary slowly across the sky, so `PsfCache` rounds the positions
+of the `PsfRequest`s to a grid before using them as keys:
+neighbouring objects share the same PSFs.
+"""
+import collections
+import hashlib
+import math
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+from hsc_to_lsst.hsc_query import downloadCutout, downloadPsf
+
+from typing import List, Optional, Tuple
+
+__all__ = ["CutoutCache", "PsfCache"]
+
+default_max_bytes = 10 * 1024**3
+default_psf_quantum = 60.0
+default_psf_memory_items = 4096
+
+# Fields of `Rect` that determine the response of the server
+_key_fields = ["rerun", "type", "filter", "tract", "ra", "dec", "sw", "sh", "image", "mask", "variance"]
+_psf_key_fields = ["rerun", "type", "filter", "tract", "patch", "ra", "dec", "centered"]
+
+
+class CutoutCache:
+    """
+    Content-addressed cache of cut-outs with LRU eviction.
+
+    The cache can be shared by several processes.
+    Its hit and miss counters are shared by the processes
+    that inherit the object from its creator.
+
+    Parameters
+    ----------
+    directory
+        Directory where the cut-outs are stored.
+    max_bytes
+        Maximum total size of the stored cut-outs.
+    """
+    def __init__(self, directory: str, max_bytes: int = default_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._hits = multiprocessing.Value("q", 0)
+        self._misses = multiprocessing.Value("q", 0)
+        # Estimate of the total size, updated by this process
+        self._size: Optional[int] = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def hits(self) -> int:
+        return self._hits.value
+
+    @property
+    def misses(self) -> int:
+        return self._misses.value
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counts.
+
+        Returns
+        -------
+        stats
+            Dictionary with keys "hits", "misses" and "hit_rate".
+        """
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+    @staticmethod
+    def key(rect: downloadCutout.Rect) -> str:
+        """
+        Compute the key of an exploded `Rect`.
+
+        Parameters
+        ----------
+        rect
+            Exploded `Rect` object, before it is sent to the server.
+
+        Returns
+        -------
+        key
+            Hexadecimal digest.
+        """
+        fields = " ".join(downloadCutout._format_rect_member[field](getattr(rect, field)) for field in _key_fields)
+        return hashlib.sha256(fields.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".pkl")
+
+    def get(self, key: str) -> Optional[List[Tuple[dict, bytes]]]:
+        """
+        Get an entry and mark it as recently used.
+
+        Parameters
+        ----------
+        key
+            Key returned by `CutoutCache.key`.
+
+        Returns
+        -------
+        items
+            List of `(metadata, data)`, or None if `key` is not in the cache.
+            `metadata` does not have "rect" in it.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                items = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self._misses.get_lock():
+                self._misses.value += 1
+            return None
+        with self._hits.get_lock():
+            self._hits.value += 1
+        return items
+
+    def put(self, key: str, items: List[Tuple[dict, bytes]]):
+        """
+        Store an entry.
+
+        Parameters
+        ----------
+        key
+            Key returned by `CutoutCache.key`.
+        items
+            List of `(metadata, data)`.
+            "rect" and "psfreq" in `metadata`, if any, are not stored.
+        """
+        items = [({k: v for k, v in metadata.items() if k not in ("rect", "psfreq")}, bytes(data))
+                 for metadata, data in items]
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+        if self._size is None:
+            self._size = self._scan()[1]
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _scan(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        """
+        List the entries in the cache.
+
+        Returns
+        -------
+        entries
+            List of `(mtime, size, path)`.
+        size
+            Total size.
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".pkl"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries, sum(entry[1] for entry in entries)
+
+    def evict(self, target_bytes: Optional[int] = None):
+        """
+        Delete the least recently used entries.
+
+        Parameters
+        ----------
+        target_bytes
+            Size to which the cache is reduced.
+            By default, 90% of `max_bytes`,
+            so that the next puts do not trigger an eviction again.
+        """
+        if target_bytes is None:
+            target_bytes = int(0.9 * self.max_bytes)
+        entries, size = self._scan()
+        entries.sort()
+        for mtime, entry_size, path in entries:
+            if size <= target_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
+
+    @staticmethod
+    def restore(items: List[Tuple[dict, bytes]], rect: downloadCutout.Rect) -> List[Tuple[dict, bytes]]:
+        """
+        Put back the fields of the metadata that are not stored in the cache.
+
+        Parameters
+        ----------
+        items
+            List of `(metadata, data)` returned by `CutoutCache.get`.
+        rect
+            The exploded `Rect` the items were requested for.
+
+        Returns
+        -------
+        items
+            List of `(metadata, data)` like those returned by `downloadCutout.download`.
+        """
+        restored = []
+        for metadata, data in items:
+            metadata = dict(metadata)
+            metadata["lineno"] = rect.lineno
+            metadata["rect"] = downloadCutout.Rect.create(tract=metadata["tract"], default=rect)
+            restored.append((metadata, data))
+        return restored
+
+
+class PsfCache:
+    """
+    Cache of PSFs keyed by rounded positions.
+
+    The entries are kept in memory, in each process,
+    and on disk if `directory` is given.
+
+    Parameters
+    ----------
+    directory
+        Directory where the PSFs are stored, or None.
+    max_bytes
+        Maximum total size of the stored PSFs.
+    quantum
+        Size, in arcseconds, of the cells of the grid
+        to which the positions are rounded.
+    max_memory_items
+        Maximum number of entries kept in memory.
+    """
+    def __init__(
+            self,
+            directory: Optional[str] = None,
+            max_bytes: int = default_max_bytes,
+            quantum: float = default_psf_quantum,
+            max_memory_items: int = default_psf_memory_items
+    ):
+        self.quantum = quantum
+        self.max_memory_items = max_memory_items
+        self._disk = CutoutCache(directory, max_bytes) if directory is not None else None
+        self._memory: "collections.OrderedDict[str, List[Tuple[dict, bytes]]]" = collections.OrderedDict()
+        self._hits = multiprocessing.Value("q", 0)
+        self._misses = multiprocessing.Value("q", 0)
+
+    @property
+    def hits(self) -> int:
+        return self._hits.value
+
+    @property
+    def misses(self) -> int:
+        return self._misses.value
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counts.
+
+        Returns
+        -------
+        stats
+            Dictionary with keys "hits", "misses" and "hit_rate".
+        """
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+    def quantize(self, psfreq: downloadPsf.PsfRequest) -> downloadPsf.PsfRequest:
+        """
+        Move a `PsfRequest` to the center of its cell.
+
+        Parameters
+        ----------
+        psfreq
+            Exploded `PsfRequest` object.
+
+        Returns
+        -------
+        psfreq
+            New `PsfRequest` object.
+        """
+        step = self.quantum / 3600
+        dec = min(90.0, (math.floor(psfreq.dec / step) + 0.5) * step)
+        ra_step = step / max(math.cos(math.radians(dec)), step)
+        ra = ((math.floor(psfreq.ra / ra_step) + 0.5) * ra_step) % 360.0
+        return downloadPsf.PsfRequest.create(ra=ra, dec=dec, default=psfreq)
+
+    @staticmethod
+    def key(psfreq: downloadPsf.PsfRequest) -> str:
+        """
+        Compute the key of an exploded, quantized `PsfRequest`.
+
+        Parameters
+        ----------
+        psfreq
+            `PsfRequest` object returned by `quantize`.
+
+        Returns
+        -------
+        key
+            Hexadecimal digest.
+        """
+        fields = " ".join(downloadPsf._format_psfreq_member[field](getattr(psfreq, field))
+                          for field in _psf_key_fields)
+        return hashlib.sha256(("psf " + fields).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[Tuple[dict, bytes]]]:
+        """
+        Get an entry.
+
+        Parameters
+        ----------
+        key
+            Key returned by `PsfCache.key`.
+
+        Returns
+        -------
+        items
+            List of `(metadata, data)`, or None if `key` is not in the cache.
+            `metadata` does not have "psfreq" in it.
+        """
+        items = self._memory.get(key)
+        if items is not None:
+            self._memory.move_to_end(key)
+        elif self._disk is not None:
+            items = self._disk.get(key)
+            if items is not None:
+                self._remember(key, items)
+        counter = self._misses if items is None else self._hits
+        with counter.get_lock():
+            counter.value += 1
+        return items
+
+    def put(self, key: str, items: List[Tuple[dict, bytes]]):
+        """
+        Store an entry.
+
+        Parameters
+        ----------
+        key
+            Key returned by `PsfCache.key`.
+        items
+            List of `(metadata, data)`.
+            "psfreq" in `metadata`, if any, is not stored.
+        """
+        items = [({k: v for k, v in metadata.items() if k != "psfreq"}, bytes(data)) for metadata, data in items]
+        self._remember(key, items)
+        if self._disk is not None:
+            self._disk.put(key, items)
+
+    def _remember(self, key: str, items: List[Tuple[dict, bytes]]):
+        self._memory[key] = items
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    @staticmethod
+    def restore(items: List[Tuple[dict, bytes]], psfreq: downloadPsf.PsfRequest) -> List[Tuple[dict, bytes]]:
+        """
+        Put back the fields of the metadata that are not stored in the cache.
+
+        Parameters
+        ----------
+        items
+            List of `(metadata, data)` returned by `PsfCache.get`.
+        psfreq
+            The exploded `PsfRequest` the items were requested for.
+
+        Returns
+        -------
+        items
+            List of `(metadata, data)` like those returned by `downloadPsf.download`.
+        """
+        restored = []
+        for metadata, data in items:
+            metadata = dict(metadata)
+            metadata["lineno"] = psfreq.lineno
+            metadata["psfreq"] = downloadPsf.PsfRequest.create(
+                tract=metadata["tract"], patch=metadata["patch"], default=psfreq)
+            restored.append((metadata, data))
+        return restored
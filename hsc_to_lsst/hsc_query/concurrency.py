@@ -0,0 +1,271 @@
+"""
+Adaptive limit on the number of requests in flight to the DAS server.
+
+`AdaptiveLimiter` can be used wherever `downloadCutout` takes a semaphore.
+Like a `multiprocessing.BoundedSemaphore`, it is shared by the processes
+that inherit it from its creator, but the number of requests it lets through
+follows an AIMD rule (additive increase, multiplicative decrease):
+the limit grows by about one per round trip while requests are fast,
+and is cut down when the server throttles, times out, or slows down.
+The rate at which requests are started can also be capped with a token bucket.
+"""
+import http.client
+import math
+import multiprocessing
+import socket
+import threading
+import time
+import urllib.error
+
+from typing import Optional
+
+__all__ = ["AdaptiveLimiter"]
+
+default_max_limit = 64
+
+# HTTP status codes meaning that the server is overloaded
+_congestion_codes = (408, 429, 502, 503, 504)
+
+
+class AdaptiveLimiter:
+    """
+    Cross-process AIMD concurrency limiter.
+
+    Use it in a `with` statement around a request.
+    The latency of the request is the time to the response header
+    if the code in the `with` block reports it with `record_latency`,
+    otherwise the time spent in the block.
+    A request that takes more than `latency_tolerance` times
+    the baseline latency plus `latency_slack`, or that fails with a congestion error
+    (HTTP 408, 429, 502, 503, 504, or a timeout),
+    multiplies the limit by `backoff`; other requests increase it by `1 / limit`.
+    The baseline is a moving average of the latencies (with weight `latency_smoothing`
+    for the latest), not their minimum: the latency grows with the number of cutouts
+    of a request, so one small request must not make all the others look slow.
+    The limit is decreased at most once per round trip:
+    only the requests started after the last decrease can decrease it again.
+
+    Parameters
+    ----------
+    initial
+        Initial limit.
+    min_limit
+        Lowest limit.
+    max_limit
+        Highest limit.
+    max_rate
+        Maximum number of requests started per second, in total.
+        If None, there is no limit.
+    burst
+        Number of requests that can be started at once
+        when the rate has been below `max_rate`. Default: `max(1, max_rate)`.
+    latency_tolerance
+        Ratio to the baseline latency above which a request is considered slow.
+    latency_slack
+        Time, in seconds, added to the threshold of slow requests,
+        so that the jitter of fast requests does not count as congestion.
+    latency_smoothing
+        Weight of the latest latency in the baseline.
+    backoff
+        Factor applied to the limit on congestion.
+    """
+    def __init__(
+            self,
+            initial: int = 8,
+            min_limit: int = 1,
+            max_limit: int = default_max_limit,
+            *,
+            max_rate: Optional[float] = None,
+            burst: Optional[float] = None,
+            latency_tolerance: float = 2.0,
+            latency_slack: float = 0.5,
+            latency_smoothing: float = 0.1,
+            backoff: float = 0.7
+    ):
+        if not (1 <= min_limit <= max_limit):
+            raise ValueError(f"Invalid limits: min_limit={min_limit}, max_limit={max_limit}")
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError(f"Rate must be positive: {max_rate}")
+        if not (0 < backoff < 1):
+            raise ValueError(f"Backoff must be between 0 and 1: {backoff}")
+        if not (0 < latency_smoothing <= 1):
+            raise ValueError(f"Latency smoothing must be between 0 and 1: {latency_smoothing}")
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_rate = max_rate
+        self.burst = burst if burst is not None else max(1.0, max_rate or 1.0)
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack = latency_slack
+        self.latency_smoothing = latency_smoothing
+        self.backoff = backoff
+
+        self._cond = multiprocessing.Condition()
+        self._limit = multiprocessing.RawValue("d", min(max(initial, min_limit), max_limit))
+        self._in_flight = multiprocessing.RawValue("i", 0)
+        self._min_latency = multiprocessing.RawValue("d", float("inf"))
+        self._baseline_latency = multiprocessing.RawValue("d", float("nan"))
+        self._last_decrease = multiprocessing.RawValue("d", 0.0)
+        self._tokens = multiprocessing.RawValue("d", self.burst)
+        self._last_refill = multiprocessing.RawValue("d", time.monotonic())
+        self._num_requests = multiprocessing.RawValue("q", 0)
+        self._num_congested = multiprocessing.RawValue("q", 0)
+        self._limit_sum = multiprocessing.RawValue("d", 0.0)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def limit(self) -> int:
+        """Current number of requests allowed in flight."""
+        return int(self._limit.value)
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests in flight."""
+        return self._in_flight.value
+
+    def acquire(self):
+        """
+        Wait until a request can be started.
+        """
+        with self._cond:
+            while True:
+                if self._in_flight.value < int(self._limit.value):
+                    wait = self._take_token()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            self._in_flight.value += 1
+
+    def _take_token(self) -> float:
+        """
+        Take a token from the bucket.
+
+        Returns
+        -------
+        wait
+            0 if a token has been taken,
+            otherwise the time, in seconds, until one is available.
+        """
+        if self.max_rate is None:
+            return 0.0
+        now = time.monotonic()
+        tokens = min(self.burst, self._tokens.value + (now - self._last_refill.value) * self.max_rate)
+        self._last_refill.value = now
+        if tokens >= 1:
+            self._tokens.value = tokens - 1
+            return 0.0
+        self._tokens.value = tokens
+        return (1 - tokens) / self.max_rate
+
+    def release(self, latency: Optional[float] = None, congested: bool = False, started: Optional[float] = None):
+        """
+        Finish a request and adapt the limit.
+
+        Parameters
+        ----------
+        latency
+            Latency of the request, in seconds.
+            If None and not `congested`, the limit is not changed.
+        congested
+            Whether or not the request failed because the server is overloaded.
+        started
+            `time.monotonic()` when the request was started.
+        """
+        with self._cond:
+            self._in_flight.value -= 1
+            limit = self._limit.value
+            if latency is not None and not congested:
+                self._min_latency.value = min(self._min_latency.value, latency)
+                baseline = self._baseline_latency.value
+                if math.isnan(baseline):
+                    baseline = latency
+                congested = latency > self.latency_tolerance * baseline + self.latency_slack
+                self._baseline_latency.value = baseline + self.latency_smoothing * (latency - baseline)
+            if congested:
+                self._num_congested.value += 1
+                if started is None or started >= self._last_decrease.value:
+                    limit = max(self.min_limit, limit * self.backoff)
+                    self._last_decrease.value = time.monotonic()
+            elif latency is not None:
+                limit = min(self.max_limit, limit + 1 / limit)
+            self._limit.value = limit
+            if latency is not None or congested:
+                self._num_requests.value += 1
+                self._limit_sum.value += limit
+            self._cond.notify_all()
+
+    def record_latency(self, latency: float):
+        """
+        Report the latency of the request being made in this thread.
+
+        Parameters
+        ----------
+        latency
+            Time, in seconds, between sending the request and receiving the response header.
+        """
+        self._local.latency = latency
+
+    def __enter__(self):
+        self.acquire()
+        self._local.started = time.monotonic()
+        self._local.latency = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        started = self._local.started
+        latency = self._local.latency
+        if exc is None and latency is None:
+            latency = time.monotonic() - started
+        congested = _is_congestion(exc)
+        if exc is not None and not congested:
+            # The request may have failed for any reason. Learn nothing from it.
+            latency = None
+        self.release(latency, congested, started)
+
+    def stats(self) -> dict:
+        """
+        Get the state of the limiter.
+
+        Returns
+        -------
+        stats
+            Dictionary with keys
+            "limit" (current limit),
+            "mean_limit" (mean limit after each request),
+            "min_latency" (shortest latency, in seconds),
+            "baseline_latency" (moving average of the latencies, in seconds),
+            "requests" (number of requests observed),
+            and "congested" (number of requests that were slow or failed because of congestion).
+        """
+        with self._cond:
+            num_requests = self._num_requests.value
+            return {
+                "limit": self._limit.value,
+                "mean_limit": self._limit_sum.value / num_requests if num_requests else self._limit.value,
+                "min_latency": self._min_latency.value,
+                "baseline_latency": self._baseline_latency.value,
+                "requests": num_requests,
+                "congested": self._num_congested.value,
+            }
+
+
+def _is_congestion(exc: Optional[BaseException]) -> bool:
+    """
+    Whether or not `exc` means that the server is overloaded.
+    """
+    if exc is None:
+        return False
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code in _congestion_codes
+    return isinstance(exc, (socket.timeout, TimeoutError, ConnectionResetError, http.client.RemoteDisconnected))
@@ -6,12 +6,18 @@ import dataclasses
 import getpass
 import io
 import math
+import http.client
 import os
+import random
 import re
 import tarfile
+import time
+import urllib.error
 import urllib.request
 from multiprocessing import BoundedSemaphore
 
+from hsc_to_lsst.hsc_query import http_pool
+
 from typing import cast, Any, Callable, Dict, Generator, IO, List, Optional, Tuple, Union
 
 __all__ = []
@@ -49,6 +55,16 @@ default_name = "{lineno}_{type}_{ra:.5f}_{dec:+.5f}_{tract}_{filter}"
 
 default_max_connections = 4
 
+# Maximum number of (exploded) rects the server accepts in a request
+max_chunksize = 990
+
+# Retries of a failed request.
+# The n-th retry waits for a random time between 0.5 and 1 times
+# min(retry_backoff * 2**(n-1), max_retry_backoff) seconds.
+max_retries = 5
+retry_backoff = 1.0
+max_retry_backoff = 60.0
+
 export("ANYTRACT")
 ANYTRACT = -1
 export("ALLFILTERS")
@@ -741,7 +757,8 @@ def download(
         password: Optional[str] = None,
         semaphore: Optional[BoundedSemaphore] = BoundedSemaphore(),
         *,
-        onmemory: bool = True) -> Union[list, List[list], None]:
+        onmemory: bool = True,
+        cache: Optional[Any] = None) -> Union[list, List[list], None]:
     """
     Cut `rects` out of the sky.
 
@@ -754,10 +771,15 @@ def download(
     password
         Password. If None, it will be asked interactively.
     semaphore
-        Semaphore object.
+        Semaphore object, or `concurrency.AdaptiveLimiter` object.
     onmemory
         Return `datalist` on memory.
         If `onmemory` is False, downloaded cut-outs are written to files.
+    cache
+        `cache.CutoutCache` object.
+        Cut-outs found in it are not downloaded,
+        and downloaded cut-outs are stored in it.
+        This can only be used with `onmemory` == True.
 
     Returns
     -------
@@ -778,7 +800,7 @@ def download(
         rects = [cast(Rect, rects)]
     rects = cast(List[Rect], rects)
 
-    ret = _download(rects, user, password, semaphore, onmemory=onmemory)
+    ret = _download(rects, user, password, semaphore, onmemory=onmemory, cache=cache)
     if isscalar and onmemory:
         ret = cast(List[list], ret)
         return ret[0]
@@ -786,13 +808,74 @@ def download(
     return ret
 
 
+@export
+def iter_download(
+        rects: List[Rect],
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        semaphore: Optional[BoundedSemaphore] = BoundedSemaphore(),
+        *,
+        cache: Optional[Any] = None
+) -> Generator[Tuple[int, dict, bytes], None, None]:
+    """
+    Cut `rects` out of the sky, yielding every cut-out as soon as it is read.
+
+    Unlike `download`, nothing is kept in memory
+    after it has been handed over to the caller.
+    The exploded rects are ordered so that all the cut-outs of a `Rect`
+    are contiguous in the stream.
+    Note that the connection (and `semaphore`) is held
+    while the caller is processing an item.
+
+    Parameters
+    ----------
+    rects
+        A list of `Rect` objects
+    user
+        Username. If None, it will be asked interactively.
+    password
+        Password. If None, it will be asked interactively.
+    semaphore
+        Semaphore object, or `concurrency.AdaptiveLimiter` object.
+    cache
+        `cache.CutoutCache` object.
+        Cut-outs found in it are yielded first, without being downloaded.
+
+    Returns
+    -------
+    generator
+        Generator yielding `(index: int, metadata: dict, data: bytes)`,
+        where `index` is the position in `rects` of the corresponding `Rect`.
+    """
+    if not rects:
+        return
+
+    exploded_rects = _explode_rects(rects, group_by_rect=True)
+    if cache is not None:
+        hits, exploded_rects = _lookup_cache(exploded_rects, cache)
+        yield from hits
+        if not exploded_rects:
+            return
+
+    user, password = _ask_credentials(user, password)
+
+    chunksize = max_chunksize
+    for i in range(0, len(exploded_rects), chunksize):
+        chunk = exploded_rects[i : i+chunksize]
+        if cache is None:
+            yield from _iter_download_chunk_resumable(chunk, user, password, semaphore)
+        else:
+            yield from _iter_download_chunk_cached(chunk, user, password, semaphore, cache)
+
+
 def _download(
         rects: List[Rect],
         user: Optional[str],
         password: Optional[str],
         semaphore: BoundedSemaphore,
         *,
-        onmemory: bool) -> Optional[List[list]]:
+        onmemory: bool,
+        cache: Optional[Any] = None) -> Optional[List[list]]:
     """
     Cut `rects` out of the sky.
 
@@ -809,6 +892,8 @@ def _download(
     onmemory
         Return `datalist` on memory.
         If `onmemory` is False, downloaded cut-outs are written to files.
+    cache
+        `cache.CutoutCache` object, or None.
 
     Returns
     -------
@@ -821,6 +906,54 @@ def _download(
     if not rects:
         return [] if onmemory else None
 
+    if cache is not None and not onmemory:
+        raise ValueError("A cache can only be used with onmemory=True.")
+
+    exploded_rects = _explode_rects(rects)
+    datalist: List[Tuple[int, dict, bytes]] = []
+    if cache is not None:
+        datalist, exploded_rects = _lookup_cache(exploded_rects, cache)
+
+    if exploded_rects:
+        user, password = _ask_credentials(user, password)
+
+    chunksize = max_chunksize
+
+    for i in range(0, len(exploded_rects), chunksize):
+        chunk = exploded_rects[i : i+chunksize]
+        if cache is None:
+            ret = _download_chunk(chunk, user, password, semaphore, onmemory=onmemory)
+        else:
+            ret = list(_iter_download_chunk_cached(chunk, user, password, semaphore, cache))
+        if onmemory:
+            datalist += cast(list, ret)
+
+    if onmemory:
+        returnedlist: List[List[Tuple[dict, bytes]]] = [[] for i in range(len(rects))]
+        for index, metadata, data in datalist:
+            returnedlist[index].append((metadata, data))
+
+    return returnedlist if onmemory else None
+
+
+def _explode_rects(rects: List[Rect], group_by_rect: bool = False) -> List[Tuple[Rect, int]]:
+    """
+    Explode `rects` and sort them for the server.
+
+    Parameters
+    ----------
+    rects
+        A list of `Rect` objects
+    group_by_rect
+        Keep the exploded rects of each `Rect` together
+        instead of sorting them by filter first.
+
+    Returns
+    -------
+    exploded_rects
+        A list of `(Rect, index)`,
+        where `index` is the position in `rects` of the original `Rect`.
+    """
     for rect in rects:
         if not rect.iscomplete():
             raise RuntimeError(f"'ra', 'dec', 'sw', and 'sh' must be specified: {rect}")
@@ -832,8 +965,31 @@ def _download(
     # Sort the rects so that the server can use cache
     # as frequently as possible.
     # We will later use `index` to sort them back.
-    exploded_rects.sort()
+    if group_by_rect:
+        exploded_rects.sort(key=lambda x: (x[0].rerun, x[0].type, x[0].tract, x[0].ra, x[0].dec, x[1], x[0]))
+    else:
+        exploded_rects.sort()
+    return exploded_rects
 
+
+def _ask_credentials(user: Optional[str], password: Optional[str]) -> Tuple[str, str]:
+    """
+    Ask the user for the username and password if they are not given.
+
+    Parameters
+    ----------
+    user
+        Username. If None, it will be asked interactively.
+    password
+        Password. If None, it will be asked interactively.
+
+    Returns
+    -------
+    user
+        Username.
+    password
+        Password.
+    """
     if not user:
         user = input("username? ").strip()
         if not user:
@@ -844,20 +1000,87 @@ def _download(
         if not password:
             raise RuntimeError("Password is empty.")
 
-    chunksize = 990
-    datalist: List[Tuple[int, dict, bytes]] = []
+    return user, password
 
-    for i in range(0, len(exploded_rects), chunksize):
-        ret = _download_chunk(exploded_rects[i : i+chunksize], user, password, semaphore, onmemory=onmemory)
-        if onmemory:
-            datalist += cast(list, ret)
 
-    if onmemory:
-        returnedlist: List[List[Tuple[dict, bytes]]] = [[] for i in range(len(rects))]
-        for index, metadata, data in datalist:
-            returnedlist[index].append((metadata, data))
+def _make_request(rects: List[Tuple[Rect, Any]], user: str, password: str) -> urllib.request.Request:
+    """
+    Make the POST request cutting `rects` out of the sky.
 
-    return returnedlist if onmemory else None
+    Parameters
+    ----------
+    rects
+        A list of `(Rect, Any)`. See `_download_chunk`.
+    user
+        Username.
+    password
+        Password.
+
+    Returns
+    -------
+    req
+        Request.
+    """
+    fields = list(_format_rect_member.keys())
+    coordlist = [f"#? {' '.join(fields)}"]
+    for rect, index in rects:
+        coordlist.append(" ".join(_format_rect_member[field](getattr(rect, field)) for field in fields))
+
+    boundary = "Boundary"
+    header = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="list"; filename="coordlist.txt"\r\n'
+        f'\r\n'
+    )
+    footer = (
+        f'\r\n'
+        f'--{boundary}--\r\n'
+    )
+
+    data = (header + "\n".join(coordlist) + footer).encode("utf-8")
+    secret = base64.standard_b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+
+    return urllib.request.Request(
+        api_url.rstrip("/") + "/cgi-bin/cutout",
+        data=data,
+        headers={
+            "Authorization": f'Basic {secret}',
+            "Content-Type": f'multipart/form-data; boundary="{boundary}"',
+        },
+        method="POST",
+    )
+
+
+def _resolve_item(rects: List[Tuple[Rect, Any]], name: str) -> Tuple[Any, dict]:
+    """
+    Find the `Rect` that an item in the returned tar file belongs to.
+
+    Parameters
+    ----------
+    rects
+        The list of `(Rect, Any)` sent to the server. See `_download_chunk`.
+    name
+        The name of an item in the tar file.
+
+    Returns
+    -------
+    marker
+        The marker attached to the `Rect`.
+    metadata
+        Metadata dictionary, with the `Rect` itself in `metadata["rect"]`.
+    """
+    metadata = _tar_decompose_item_name(name)
+    rect, index = rects[metadata["lineno"] - 2]
+    # Overwrite metadata's lineno (= lineno in this chunk)
+    # with rect's lineno (= global lineno)
+    # for fear of confusion.
+    metadata["lineno"] = rect.lineno
+    # Overwrite rect's tract (which may be ANYTRACT)
+    # with metadata's tract (which is always a valid value)
+    # for fear of confusion.
+    rect.tract = metadata["tract"]
+    metadata["rect"] = rect
+    return index, metadata
 
 
 def _download_chunk(
@@ -897,67 +1120,237 @@ def _download_chunk(
         Two or more elements in this list may result
         from a single `Rect` object.
     """
-    fields = list(_format_rect_member.keys())
-    coordlist = [f"#? {' '.join(fields)}"]
-    for rect, index in rects:
-        coordlist.append(" ".join(_format_rect_member[field](getattr(rect, field)) for field in fields))
+    returnedlist = []
 
-    boundary = "Boundary"
-    header = (
-        f'--{boundary}\r\n'
-        f'Content-Disposition: form-data; name="list"; filename="coordlist.txt"\r\n'
-        f'\r\n'
-    )
-    footer = (
-        f'\r\n'
-        f'--{boundary}--\r\n'
-    )
+    for index, metadata, data in _iter_download_chunk_resumable(rects, user, password, semaphore):
+        if onmemory:
+            returnedlist.append((index, metadata, data))
+        else:
+            filename = make_filename(metadata)
+            dirname = os.path.dirname(filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(filename, "wb") as fout:
+                fout.write(data)
 
-    data = (header + "\n".join(coordlist) + footer).encode("utf-8")
-    secret = base64.standard_b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+    return returnedlist if onmemory else None
 
-    req = urllib.request.Request(
-        api_url.rstrip("/") + "/cgi-bin/cutout",
-        data=data,
-        headers={
-            "Authorization": f'Basic {secret}',
-            "Content-Type": f'multipart/form-data; boundary="{boundary}"',
-        },
-        method="POST",
-    )
 
-    returnedlist = []
+def _iter_download_chunk(
+        rects: List[Tuple[Rect, Any]],
+        user: str,
+        password: str,
+        semaphore: BoundedSemaphore
+) -> Generator[Tuple[Any, dict, bytearray], None, None]:
+    """
+    Cut `rects` out of the sky, iterating over the items in the returned tar.
+
+    Parameters
+    ----------
+    rects
+        A list of `(Rect, Any)`. See `_download_chunk`.
+    user
+        Username.
+    password
+        Password.
+    semaphore
+        Semaphore object.
+
+    Returns
+    -------
+    generator
+        Generator yielding `(marker: Any, metadata: dict, data: bytearray)`.
+        `data` is read straight into a writable buffer,
+        so that `fits_decode.decode_image` can decode it without copying.
+    """
+    req = _make_request(rects, user, password)
 
     with semaphore:
-        with urllib.request.urlopen(req, timeout=3600) as fin:
+        start = time.monotonic()
+        with http_pool.urlopen(req, timeout=3600) as fin:
+            # An adaptive limiter (`concurrency.AdaptiveLimiter`) wants to know
+            # how long the server took to respond.
+            if hasattr(semaphore, "record_latency"):
+                semaphore.record_latency(time.monotonic() - start)
             with tarfile.open(fileobj=fin, mode="r|") as tar:
                 for info in tar:
                     fitem = tar.extractfile(info)
                     if fitem is None:
                         continue
                     with fitem:
-                        metadata = _tar_decompose_item_name(info.name)
-                        rect, index = rects[metadata["lineno"] - 2]
-                        # Overwrite metadata's lineno (= lineno in this chunk)
-                        # with rect's lineno (= global lineno)
-                        # for fear of confusion.
-                        metadata["lineno"] = rect.lineno
-                        # Overwrite rect's tract (which may be ANYTRACT)
-                        # with metadata's tract (which is always a valid value)
-                        # for fear of confusion.
-                        rect.tract = metadata["tract"]
-                        metadata["rect"] = rect
-                        if onmemory:
-                            returnedlist.append((index, metadata, fitem.read()))
-                        else:
-                            filename = make_filename(metadata)
-                            dirname = os.path.dirname(filename)
-                            if dirname:
-                                os.makedirs(dirname, exist_ok=True)
-                            with open(filename, "wb") as fout:
-                                _splice(fitem, fout)
+                        data = bytearray(info.size)
+                        if fitem.readinto(data) != info.size:
+                            raise tarfile.ReadError("unexpected end of data")
+                    index, metadata = _resolve_item(rects, info.name)
+                    yield index, metadata, data
 
-    return returnedlist if onmemory else None
+
+def _iter_download_chunk_resumable(
+        rects: List[Tuple[Rect, Any]],
+        user: str,
+        password: str,
+        semaphore: BoundedSemaphore
+) -> Generator[Tuple[Any, dict, bytes], None, None]:
+    """
+    Cut `rects` out of the sky, retrying on failure.
+
+    If the request fails, it is sent again after a randomized exponential backoff
+    (see `max_retries`, `retry_backoff`, and `max_retry_backoff`).
+    Rects whose items have all been received are not requested again:
+    the items of a rect are held back until those of the next rect begin,
+    so that an item is never yielded twice.
+
+    Parameters
+    ----------
+    rects
+        A list of `(Rect, Any)`. See `_download_chunk`.
+    user
+        Username.
+    password
+        Password.
+    semaphore
+        Semaphore object.
+
+    Returns
+    -------
+    generator
+        Generator yielding `(marker: Any, metadata: dict, data: bytes)`.
+    """
+    # `_resolve_item` overwrites the tracts of the rects;
+    # the rects sent again must ask for what they asked for at first.
+    tracts = [rect.tract for rect, marker in rects]
+    pending = list(range(len(rects)))
+    failures = 0
+
+    while pending:
+        request = [(rects[i][0], (k, rects[i][1])) for k, i in enumerate(pending)]
+        current = -1
+        items: List[Tuple[Any, dict, bytes]] = []
+        try:
+            for (k, marker), metadata, data in _iter_download_chunk(request, user, password, semaphore):
+                if k != current:
+                    # The server returns the items in the order of the lines in the request,
+                    # so the previous rects are complete.
+                    if current >= 0:
+                        failures = 0
+                    yield from items
+                    current, items = k, []
+                items.append((marker, metadata, data))
+            yield from items
+            return
+        except Exception as e:
+            if not _is_retryable(e) or failures >= max_retries:
+                raise
+            failures += 1
+            if current >= 0:
+                pending = pending[current:]
+                for i in pending:
+                    rects[i][0].tract = tracts[i]
+            delay = min(retry_backoff * 2**(failures - 1), max_retry_backoff)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def _is_retryable(e: Exception) -> bool:
+    """
+    Whether or not a request that failed with `e` may succeed if it is sent again.
+
+    Parameters
+    ----------
+    e
+        Exception.
+
+    Returns
+    -------
+    retryable
+        True if the request should be sent again.
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code >= 500 or e.code in (408, 429)
+    return isinstance(e, (OSError, tarfile.TarError, http.client.HTTPException))
+
+
+def _lookup_cache(rects: List[Tuple[Rect, int]], cache: Any) -> Tuple[List[Tuple[int, dict, bytes]], List[Tuple[Rect, Tuple[int, str]]]]:
+    """
+    Look exploded rects up in a cache.
+
+    Parameters
+    ----------
+    rects
+        A list of `(Rect, index)` returned by `_explode_rects`.
+    cache
+        `cache.CutoutCache` object.
+
+    Returns
+    -------
+    hits
+        A list of `(index, metadata, data)` found in the cache.
+    misses
+        A list of `(Rect, (index, key))` not found in the cache,
+        where `key` is the key of the `Rect` in the cache.
+    """
+    hits: List[Tuple[int, dict, bytes]] = []
+    misses: List[Tuple[Rect, Tuple[int, str]]] = []
+    for rect, index in rects:
+        key = cache.key(rect)
+        items = cache.get(key)
+        if items is None:
+            misses.append((rect, (index, key)))
+        else:
+            hits.extend((index, metadata, data) for metadata, data in cache.restore(items, rect))
+    return hits, misses
+
+
+def _iter_download_chunk_cached(
+        rects: List[Tuple[Rect, Tuple[int, str]]],
+        user: str,
+        password: str,
+        semaphore: BoundedSemaphore,
+        cache: Any
+) -> Generator[Tuple[int, dict, bytes], None, None]:
+    """
+    Cut `rects` out of the sky, storing the cut-outs in a cache.
+
+    Parameters
+    ----------
+    rects
+        A list of `(Rect, (index, key))` returned by `_lookup_cache`.
+    user
+        Username.
+    password
+        Password.
+    semaphore
+        Semaphore object.
+    cache
+        `cache.CutoutCache` object.
+
+    Returns
+    -------
+    generator
+        Generator yielding `(index: int, metadata: dict, data: bytes)`.
+    """
+    # The server returns the items in the order of the lines in the request,
+    # so the entry of a rect is complete when the next rect begins.
+    stored = set()
+    current_key = None
+    items: List[Tuple[dict, bytes]] = []
+    for (index, key), metadata, data in _iter_download_chunk_resumable(rects, user, password, semaphore):
+        if key != current_key:
+            if current_key is not None:
+                cache.put(current_key, items)
+                stored.add(current_key)
+            current_key, items = key, []
+        # Keep a copy: the caller may decode `data` in place
+        items.append((metadata, bytes(data)))
+        yield index, metadata, data
+
+    if current_key is not None:
+        cache.put(current_key, items)
+        stored.add(current_key)
+    # The rects for which there was no data
+    for rect, (index, key) in rects:
+        if key not in stored:
+            cache.put(key, [])
+            stored.add(key)
 
 
 _format_rect_member: Dict[str, Callable[[str], Any]] = {
@@ -1041,21 +1434,3 @@ def make_filename(metadata: dict) -> str:
     name = args.pop("name")
     return name.format(**args) + ".fits"
 
-
-def _splice(fin: IO[bytes], fout: IO[bytes]):
-    """
-    Read from `fin` and write to `fout` until the end of file.
-
-    Parameters
-    ----------
-    fin
-        Input file.
-    fout
-        Output file.
-    """
-    buffer = memoryview(bytearray(10485760))
-    while True:
-        n = fin.readinto(buffer)
-        if n <= 0:
-            break
-        fout.write(buffer[:n])
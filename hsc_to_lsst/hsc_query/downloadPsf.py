@@ -11,7 +11,11 @@ import os
 import re
 import sys
 import tarfile
+import time
 import urllib.request
+from multiprocessing import BoundedSemaphore
+
+from hsc_to_lsst.hsc_query import http_pool
 
 from typing import cast, Any, Callable, Dict, Generator, IO, List, Optional, Tuple, Union
 
@@ -823,7 +827,14 @@ def parse_filter_opt(s: Optional[str]) -> str:
 
 
 @export
-def download(psfreqs: Union[PsfRequest, List[PsfRequest]], user: Optional[str] = None, password: Optional[str] = None, *, onmemory: bool = True) -> Union[list, List[list], None]:
+def download(
+        psfreqs: Union[PsfRequest, List[PsfRequest]],
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        semaphore: Optional[BoundedSemaphore] = BoundedSemaphore(),
+        *,
+        onmemory: bool = True,
+        cache: Optional[Any] = None) -> Union[list, List[list], None]:
     """
     Download PSFs by sending `psfreqs`.
 
@@ -835,9 +846,18 @@ def download(psfreqs: Union[PsfRequest, List[PsfRequest]], user: Optional[str] =
         Username. If None, it will be asked interactively.
     password
         Password. If None, it will be asked interactively.
+    semaphore
+        Semaphore object.
     onmemory
         Return `datalist` on memory.
         If `onmemory` is False, downloaded PSFs are written to files.
+    cache
+        `cache.PsfCache` object.
+        The positions of `psfreqs` are rounded to its grid,
+        PSFs found in it are not downloaded,
+        and downloaded PSFs are stored in it.
+        Requests that round to the same position are sent only once.
+        This can only be used with `onmemory` == True.
 
     Returns
     -------
@@ -858,7 +878,7 @@ def download(psfreqs: Union[PsfRequest, List[PsfRequest]], user: Optional[str] =
         psfreqs = [cast(PsfRequest, psfreqs)]
     psfreqs = cast(List[PsfRequest], psfreqs)
 
-    ret = _download(psfreqs, user, password, onmemory=onmemory)
+    ret = _download(psfreqs, user, password, semaphore, onmemory=onmemory, cache=cache)
     if isscalar and onmemory:
         ret = cast(List[list], ret)
         return ret[0]
@@ -866,7 +886,14 @@ def download(psfreqs: Union[PsfRequest, List[PsfRequest]], user: Optional[str] =
     return ret
 
 
-def _download(psfreqs: List[PsfRequest], user: Optional[str], password: Optional[str], *, onmemory: bool) -> Optional[List[list]]:
+def _download(
+        psfreqs: List[PsfRequest],
+        user: Optional[str],
+        password: Optional[str],
+        semaphore: BoundedSemaphore,
+        *,
+        onmemory: bool,
+        cache: Optional[Any] = None) -> Optional[List[list]]:
     """
     Download PSFs by sending `psfreqs`.
 
@@ -878,9 +905,13 @@ def _download(psfreqs: List[PsfRequest], user: Optional[str], password: Optional
         Username. If None, it will be asked interactively.
     password
         Password. If None, it will be asked interactively.
+    semaphore
+        Semaphore object.
     onmemory
         Return `datalist` on memory.
         If `onmemory` is False, downloaded PSFs are written to files.
+    cache
+        `cache.PsfCache` object, or None.
 
     Returns
     -------
@@ -890,6 +921,9 @@ def _download(psfreqs: List[PsfRequest], user: Optional[str], password: Optional
         `datalist[i]` corresponds to `psfreqs[i]`, and
         `datalist[i][j]` is a tuple `(metadata: dict, data: bytes)`.
     """
+    if cache is not None and not onmemory:
+        raise ValueError("A cache can only be used with onmemory=True.")
+
     if not psfreqs:
         return [] if onmemory else None
 
@@ -897,31 +931,37 @@ def _download(psfreqs: List[PsfRequest], user: Optional[str], password: Optional
         if not psfreq.iscomplete():
             raise RuntimeError(f"'ra' and 'dec' must be specified: {psfreq}")
 
-    exploded_psfreqs: List[Tuple[PsfRequest, int]] = []
+    exploded_psfreqs: List[Tuple[PsfRequest, Any]] = []
     for index, psfreq in enumerate(psfreqs):
         exploded_psfreqs.extend((r, index) for r in psfreq.explode())
 
+    datalist: List[Tuple[int, dict, bytes]] = []
+    if cache is not None:
+        datalist, exploded_psfreqs = _lookup_cache(exploded_psfreqs, cache)
+
     # Sort the psfreqs so that the server can use cache
     # as frequently as possible.
     # We will later use `index` to sort them back.
-    exploded_psfreqs.sort()
+    exploded_psfreqs.sort(key=lambda x: x[0])
 
-    if not user:
+    if exploded_psfreqs and not user:
         user = input("username? ").strip()
         if not user:
             raise RuntimeError("User name is empty.")
 
-    if not password:
+    if exploded_psfreqs and not password:
         password = getpass.getpass(prompt="password? ")
         if not password:
             raise RuntimeError("Password is empty.")
 
     chunksize = 990
-    datalist: List[Tuple[int, dict, bytes]] = []
 
     for i in range(0, len(exploded_psfreqs), chunksize):
-        ret = _download_chunk(exploded_psfreqs[i : i+chunksize], user, password, onmemory=onmemory)
-        if onmemory:
+        chunk = exploded_psfreqs[i : i+chunksize]
+        ret = _download_chunk(chunk, user, password, semaphore, onmemory=onmemory)
+        if cache is not None:
+            datalist += _store_cache(chunk, cast(list, ret), cache)
+        elif onmemory:
             datalist += cast(list, ret)
 
     if onmemory:
@@ -932,7 +972,7 @@ def _download(psfreqs: List[PsfRequest], user: Optional[str], password: Optional
     return returnedlist if onmemory else None
 
 
-def _download_chunk(psfreqs: List[Tuple[PsfRequest, Any]], user: str, password: str, *, onmemory: bool) -> Optional[list]:
+def _download_chunk(psfreqs: List[Tuple[PsfRequest, Any]], user: str, password: str, semaphore: BoundedSemaphore, *, onmemory: bool) -> Optional[list]:
     """
     Download PSFs by sending `psfreqs`.
 
@@ -948,6 +988,8 @@ def _download_chunk(psfreqs: List[Tuple[PsfRequest, Any]], user: str, password:
         Username.
     password
         Password.
+    semaphore
+        Semaphore object.
     onmemory
         Return `datalist` on memory.
         If `onmemory` is False, downloaded PSFs are written to files.
@@ -993,38 +1035,112 @@ def _download_chunk(psfreqs: List[Tuple[PsfRequest, Any]], user: str, password:
 
     returnedlist = []
 
-    with urllib.request.urlopen(req, timeout=3600) as fin:
-        with tarfile.open(fileobj=fin, mode="r|") as tar:
-            for info in tar:
-                fitem = tar.extractfile(info)
-                if fitem is None:
-                    continue
-                with fitem:
-                    metadata = _tar_decompose_item_name(info.name)
-                    psfreq, index = psfreqs[metadata["lineno"] - 2]
-                    # Overwrite metadata's lineno (= lineno in this chunk)
-                    # with psfreq's lineno (= global lineno)
-                    # for fear of confusion.
-                    metadata["lineno"] = psfreq.lineno
-                    # Overwrite psfreq's tract and patch (which may be ANYTRACT, ANYPATCH)
-                    # with metadata's tract and patch (which always have valid values)
-                    # for fear of confusion.
-                    psfreq.tract = metadata["tract"]
-                    psfreq.patch = metadata["patch"]
-                    metadata["psfreq"] = psfreq
-                    if onmemory:
-                        returnedlist.append((index, metadata, fitem.read()))
-                    else:
-                        filename = make_filename(metadata)
-                        dirname = os.path.dirname(filename)
-                        if dirname:
-                            os.makedirs(dirname, exist_ok=True)
-                        with open(filename, "wb") as fout:
-                            _splice(fitem, fout)
+    with semaphore or contextlib.nullcontext():
+        start = time.monotonic()
+        with http_pool.urlopen(req, timeout=3600) as fin:
+            # An adaptive limiter (`concurrency.AdaptiveLimiter`) wants to know
+            # how long the server took to respond, not how long the PSFs took to arrive.
+            if hasattr(semaphore, "record_latency"):
+                semaphore.record_latency(time.monotonic() - start)
+            with tarfile.open(fileobj=fin, mode="r|") as tar:
+                for info in tar:
+                    fitem = tar.extractfile(info)
+                    if fitem is None:
+                        continue
+                    with fitem:
+                        metadata = _tar_decompose_item_name(info.name)
+                        psfreq, index = psfreqs[metadata["lineno"] - 2]
+                        # Overwrite metadata's lineno (= lineno in this chunk)
+                        # with psfreq's lineno (= global lineno)
+                        # for fear of confusion.
+                        metadata["lineno"] = psfreq.lineno
+                        # Overwrite psfreq's tract and patch (which may be ANYTRACT, ANYPATCH)
+                        # with metadata's tract and patch (which always have valid values)
+                        # for fear of confusion.
+                        psfreq.tract = metadata["tract"]
+                        psfreq.patch = metadata["patch"]
+                        metadata["psfreq"] = psfreq
+                        if onmemory:
+                            returnedlist.append((index, metadata, fitem.read()))
+                        else:
+                            filename = make_filename(metadata)
+                            dirname = os.path.dirname(filename)
+                            if dirname:
+                                os.makedirs(dirname, exist_ok=True)
+                            with open(filename, "wb") as fout:
+                                _splice(fitem, fout)
 
     return returnedlist if onmemory else None
 
 
+def _lookup_cache(psfreqs: List[Tuple[PsfRequest, Any]], cache: Any) -> Tuple[List[Tuple[Any, dict, bytes]], List[Tuple[PsfRequest, Tuple[str, List[Tuple[Any, PsfRequest]]]]]]:
+    """
+    Look exploded psfreqs up in a cache.
+
+    Parameters
+    ----------
+    psfreqs
+        A list of `(PsfRequest, index)`.
+    cache
+        `cache.PsfCache` object.
+
+    Returns
+    -------
+    hits
+        A list of `(index, metadata, data)` found in the cache.
+    misses
+        A list of `(PsfRequest, (key, [(index, PsfRequest), ...]))` not found in the cache,
+        where the first `PsfRequest` is the quantized request to send,
+        `key` is its key in the cache,
+        and the list holds the original requests that round to it.
+    """
+    hits: List[Tuple[Any, dict, bytes]] = []
+    misses: Dict[str, Tuple[PsfRequest, List[Tuple[Any, PsfRequest]]]] = {}
+    for psfreq, index in psfreqs:
+        quantized = cache.quantize(psfreq)
+        key = cache.key(quantized)
+        if key in misses:
+            misses[key][1].append((index, psfreq))
+            continue
+        items = cache.get(key)
+        if items is None:
+            misses[key] = (quantized, [(index, psfreq)])
+        else:
+            hits.extend((index, metadata, data) for metadata, data in cache.restore(items, psfreq))
+    return hits, [(quantized, (key, originals)) for key, (quantized, originals) in misses.items()]
+
+
+def _store_cache(psfreqs: List[Tuple[PsfRequest, Any]], returnedlist: List[Tuple[Any, dict, bytes]], cache: Any) -> List[Tuple[Any, dict, bytes]]:
+    """
+    Store downloaded PSFs in a cache, and hand them to the requests that share them.
+
+    Parameters
+    ----------
+    psfreqs
+        A list of `(PsfRequest, (key, originals))` sent to the server,
+        as returned by `_lookup_cache`.
+    returnedlist
+        Output of `_download_chunk`.
+    cache
+        `cache.PsfCache` object.
+
+    Returns
+    -------
+    datalist
+        A list of `(index, metadata, data)`.
+    """
+    items: Dict[str, List[Tuple[dict, bytes]]] = {key: [] for psfreq, (key, originals) in psfreqs}
+    for (key, originals), metadata, data in returnedlist:
+        items[key].append((metadata, data))
+
+    datalist: List[Tuple[Any, dict, bytes]] = []
+    for psfreq, (key, originals) in psfreqs:
+        cache.put(key, items[key])
+        for index, original in originals:
+            datalist.extend((index, metadata, data) for metadata, data in cache.restore(items[key], original))
+    return datalist
+
+
 _format_psfreq_member: Dict[str, Callable[[str], Any]] = {
     "rerun": str,
     "type": str,
@@ -0,0 +1,282 @@
+"""
+Fast decoding of the FITS files returned by the DAS server.
+
+`astropy.io.fits` parses every card of every HDU and copies the pixels
+at least once more than needed.
+The cut-outs are plain images, so `decode_image` reads only the structural
+keywords, skips the empty primary HDU, and makes the pixel array
+a view of the downloaded buffer, swapping its bytes in place.
+`decode_images` does the same for all the images of a file
+(the image, mask and variance planes of a cut-out).
+The header is parsed only when it is used (see `LazyHeader`).
+Anything unusual (scaled or compressed data) is handed over to astropy.
+"""
+import io
+import math
+
+import numpy as np
+from astropy.io import fits
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+__all__ = ["LazyHeader", "decode_image", "decode_images"]
+
+_block_size = 2880
+_card_size = 80
+
+_dtypes = {
+    8: np.dtype("u1"),
+    16: np.dtype(">i2"),
+    32: np.dtype(">i4"),
+    64: np.dtype(">i8"),
+    -32: np.dtype(">f4"),
+    -64: np.dtype(">f8"),
+}
+
+
+class LazyHeader:
+    """
+    FITS header parsed on demand.
+
+    Reading a keyword only needs a quick scan of the cards.
+    Anything else (assigning a keyword, `copy()`, or any other method
+    of `astropy.io.fits.Header`) parses the whole header first;
+    `to_header()` returns the parsed `astropy.io.fits.Header`.
+
+    Parameters
+    ----------
+    raw
+        The header, as it is in the FITS file.
+    header
+        Already parsed header. Either `raw` or `header` must be given.
+    """
+    def __init__(self, raw: Optional[bytes] = None, header: Optional[fits.Header] = None):
+        if raw is None and header is None:
+            raise ValueError("Either 'raw' or 'header' must be given.")
+        self._raw = raw
+        self._header = header
+        self._values: Optional[Dict[str, Any]] = None
+
+    def to_header(self) -> fits.Header:
+        """
+        Get the parsed header.
+
+        Returns
+        -------
+        header
+            `astropy.io.fits.Header` object, which is that of `self` from now on.
+        """
+        if self._header is None:
+            self._header = fits.Header.fromstring(self._raw.decode("ascii"))
+        return self._header
+
+    def _scan(self) -> Dict[str, Any]:
+        if self._values is None:
+            self._values = _parse_cards(self._raw)[0]
+        return self._values
+
+    def __getitem__(self, key: str) -> Any:
+        if self._header is not None:
+            return self._header[key]
+        return self._scan()[key.upper()]
+
+    def __setitem__(self, key: str, value: Any):
+        self.to_header()[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        if self._header is not None:
+            return key in self._header
+        return key.upper() in self._scan()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.to_header(), name)
+
+    def __repr__(self) -> str:
+        return repr(self.to_header())
+
+
+def decode_image(data: Union[bytes, bytearray, memoryview]) -> Tuple[np.ndarray, LazyHeader]:
+    """
+    Decode the first image in a FITS file.
+
+    If `data` is writable (e.g. a `bytearray`), the pixels are byte-swapped in place
+    and the returned array shares memory with `data`,
+    which therefore cannot be decoded again.
+    Otherwise the pixels are copied once.
+
+    Parameters
+    ----------
+    data
+        Content of the FITS file.
+
+    Returns
+    -------
+    image
+        2D array in native byte order.
+    header
+        Header of the image HDU.
+    """
+    for image in _iter_images(data):
+        return image
+    raise ValueError("No image in the FITS file")
+
+
+def decode_images(data: Union[bytes, bytearray, memoryview]) -> List[Tuple[np.ndarray, LazyHeader]]:
+    """
+    Decode all the images in a FITS file.
+
+    Same as `decode_image`, for every image HDU:
+    the image, mask and variance planes of a cut-out, in this order.
+
+    Parameters
+    ----------
+    data
+        Content of the FITS file.
+
+    Returns
+    -------
+    images
+        List of `(image, header)`.
+    """
+    images = list(_iter_images(data))
+    if not images:
+        raise ValueError("No image in the FITS file")
+    return images
+
+
+def _iter_images(data: Union[bytes, bytearray, memoryview]) -> Iterator[Tuple[np.ndarray, LazyHeader]]:
+    """
+    Decode the image HDUs of a FITS file one by one.
+    """
+    buf = memoryview(data).cast("B")
+    offset = 0
+    while offset < len(buf):
+        values, header_end = _parse_cards(buf, offset)
+        bitpix = int(values.get("BITPIX", 8))
+        naxis = int(values.get("NAXIS", 0))
+        shape = tuple(int(values[f"NAXIS{i}"]) for i in range(naxis, 0, -1))
+        count = math.prod(shape) if naxis else 0
+        size = abs(bitpix) // 8 * int(values.get("GCOUNT", 1)) * (int(values.get("PCOUNT", 0)) + count)
+
+        is_image = "SIMPLE" in values or values.get("XTENSION") == "IMAGE"
+        if naxis >= 2 and not is_image or values.get("ZIMAGE"):
+            # Compressed image or table
+            yield from _decode_with_astropy(data, offset)
+            return
+        if naxis >= 2:
+            if values.get("BSCALE", 1) != 1 or values.get("BZERO", 0) != 0 or bitpix not in _dtypes:
+                yield from _decode_with_astropy(data, offset)
+                return
+            if header_end + count * abs(bitpix) // 8 > len(buf):
+                raise ValueError("Truncated FITS file")
+            image = _view(buf, _dtypes[bitpix], count, header_end).reshape(shape)
+            yield image, LazyHeader(bytes(buf[offset:header_end]))
+
+        offset = header_end + -(-size // _block_size) * _block_size
+
+
+def _view(buf: memoryview, dtype: np.dtype, count: int, offset: int) -> np.ndarray:
+    """
+    Make a native-endian array of big-endian data in `buf`.
+    """
+    array = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    native = dtype.newbyteorder("=")
+    if native == dtype:
+        return array if not buf.readonly else array.copy()
+    if buf.readonly:
+        return array.astype(native)
+    array.byteswap(inplace=True)
+    return array.view(native)
+
+
+def _decode_with_astropy(data: Union[bytes, bytearray, memoryview],
+                         offset: int = 0) -> Iterator[Tuple[np.ndarray, LazyHeader]]:
+    """
+    Decode the image HDUs of a FITS file with astropy, from the HDU at `offset` on.
+    """
+    with fits.open(io.BytesIO(data)) as hdul:
+        for hdu in hdul:
+            if hdu.fileinfo()["hdrLoc"] < offset:
+                continue
+            if hdu.is_image and hdu.data is not None and hdu.data.ndim >= 2 or isinstance(hdu, fits.CompImageHDU):
+                yield np.asarray(hdu.data), LazyHeader(header=hdu.header.copy())
+
+
+def _parse_cards(buf: Union[bytes, memoryview], offset: int = 0) -> Tuple[Dict[str, Any], int]:
+    """
+    Read the values of the cards of a header.
+
+    Parameters
+    ----------
+    buf
+        Buffer.
+    offset
+        Position of the header in `buf`.
+
+    Returns
+    -------
+    values
+        Dictionary from keywords to values.
+        COMMENT, HISTORY, and the like are not included.
+    end
+        Position of the end of the header (the beginning of the data) in `buf`.
+    """
+    values: Dict[str, Any] = {}
+    pos = offset
+    while True:
+        if pos + _block_size > len(buf):
+            raise ValueError("Truncated FITS header")
+        block = bytes(buf[pos:pos + _block_size]).decode("ascii", errors="replace")
+        pos += _block_size
+        for i in range(0, _block_size, _card_size):
+            card = block[i:i + _card_size]
+            key = card[:8].rstrip()
+            if key == "END":
+                return values, pos
+            if card[8:10] == "= ":
+                values[key] = _parse_value(card[10:])
+            elif key == "HIERARCH" and "=" in card:
+                name, value = card[9:].split("=", 1)
+                values[name.strip().upper()] = _parse_value(value)
+
+
+def _parse_value(s: str) -> Any:
+    """
+    Interpret the value field of a card.
+    """
+    s = s.strip()
+    if s.startswith("'"):
+        # String, in which '' is a quote
+        chars = []
+        i = 1
+        while i < len(s):
+            if s[i] == "'":
+                if s[i + 1:i + 2] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(s[i])
+            i += 1
+        return "".join(chars).rstrip()
+    s = s.split("/", 1)[0].strip()
+    if s == "T":
+        return True
+    if s == "F":
+        return False
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s.replace("D", "E"))
+    except ValueError:
+        return s
@@ -0,0 +1,177 @@
+"""
+Grouping of catalog targets whose cutouts overlap.
+
+In crowded fields, several targets of a batch may be closer to each other
+than the size of a cutout, and the server would send the same pixels several times.
+`group_targets` clusters such targets so that a single, larger cutout
+is requested for each group; `slice_stamp` then cuts the stamp of every target
+out of the cutout of its group.
+"""
+import dataclasses
+
+import numpy as np
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+
+from typing import List, Sequence
+
+__all__ = ["TargetGroup", "group_targets", "slice_stamp"]
+
+default_max_group_size = 60.0
+hsc_pix_scale = 0.168
+
+
+@dataclasses.dataclass
+class TargetGroup:
+    """
+    Targets cut out of a single cutout.
+
+    Parameters
+    ----------
+    members
+        Indices of the targets in the catalog.
+    ra, dec
+        Center of the cutout, in degrees.
+    size
+        Width of the cutout, in arcseconds.
+    """
+    members: List[int]
+    ra: float
+    dec: float
+    size: float
+
+
+def group_targets(
+        ra: Sequence[float],
+        dec: Sequence[float],
+        size: float,
+        max_group_size: float = default_max_group_size
+) -> List[TargetGroup]:
+    """
+    Group the targets whose cutouts overlap.
+
+    Two targets are linked if their cutouts overlap;
+    linked targets are merged into a group as long as the cutout
+    covering the whole group is not wider than `max_group_size`.
+
+    Parameters
+    ----------
+    ra, dec
+        Positions of the targets, in degrees.
+    size
+        Width of the cutout of a target, in arcseconds.
+    max_group_size
+        Maximum width of the cutout of a group, in arcseconds.
+
+    Returns
+    -------
+    groups
+        Groups, in the order of their first members.
+        A target that overlaps no other is a group by itself, of width `size`.
+    """
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    n = len(ra)
+    if n == 0:
+        return []
+
+    # Offsets in arcseconds on the plane tangent at the mean position
+    ra0 = np.degrees(np.angle(np.mean(np.exp(1j * np.radians(ra)))))
+    dec0 = float(np.mean(dec))
+    x = ((ra - ra0 + 180) % 360 - 180) * np.cos(np.radians(dec)) * 3600
+    y = (dec - dec0) * 3600
+
+    parent = list(range(n))
+    # Bounding box of each group, held by its root
+    xmin, xmax, ymin, ymax = x.copy(), x.copy(), y.copy(), y.copy()
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if max_group_size > size:
+        tree = cKDTree(np.stack([x, y], axis=-1))
+        pairs = sorted(tree.query_pairs(size, p=np.inf, output_type="ndarray").tolist(),
+                       key=lambda pair: max(abs(x[pair[0]] - x[pair[1]]), abs(y[pair[0]] - y[pair[1]])))
+        for i, j in pairs:
+            ri, rj = find(i), find(j)
+            if ri == rj:
+                continue
+            bx0, bx1 = min(xmin[ri], xmin[rj]), max(xmax[ri], xmax[rj])
+            by0, by1 = min(ymin[ri], ymin[rj]), max(ymax[ri], ymax[rj])
+            if max(bx1 - bx0, by1 - by0) + size > max_group_size:
+                continue
+            parent[rj] = ri
+            xmin[ri], xmax[ri], ymin[ri], ymax[ri] = bx0, bx1, by0, by1
+
+    members = {}
+    for i in range(n):
+        members.setdefault(find(i), []).append(i)
+
+    groups = []
+    for root, indices in members.items():
+        if len(indices) == 1:
+            i = indices[0]
+            groups.append(TargetGroup(indices, float(ra[i]), float(dec[i]), size))
+            continue
+        cx = (xmin[root] + xmax[root]) / 2
+        cy = (ymin[root] + ymax[root]) / 2
+        group_dec = dec0 + cy / 3600
+        group_ra = (ra0 + cx / 3600 / np.cos(np.radians(group_dec))) % 360
+        extent = max(xmax[root] - xmin[root], ymax[root] - ymin[root])
+        # A pixel of margin on each side for the rounding of the stamp centers
+        groups.append(TargetGroup(indices, float(group_ra), float(group_dec), extent + size + 2 * hsc_pix_scale))
+    return groups
+
+
+def slice_stamp(band_data: dict, ra: float, dec: float, size: float) -> dict:
+    """
+    Cut the stamp of a target out of the cutout of its group.
+
+    Parameters
+    ----------
+    band_data
+        Dictionary with keys "image", "hdr" and "metadata",
+        and possibly "mask", "mask_hdr" and "variance",
+        as in the output of `query.query_hsc`.
+    ra, dec
+        Position of the target, in degrees.
+    size
+        Width of the stamp, in arcseconds.
+
+    Returns
+    -------
+    band_data
+        New dictionary with the stamp (and its mask and variance),
+        the header with CRPIX shifted accordingly, and a copy of the metadata.
+        The stamp is clipped to the cutout of the group.
+    """
+    hdr = band_data['hdr']
+    if hasattr(hdr, 'to_header'):
+        hdr = hdr.to_header()
+    wcs = WCS(hdr)
+    pix_scale = np.sqrt(np.abs(np.linalg.det(wcs.pixel_scale_matrix))) * 3600
+    half = int(round(size / 2 / pix_scale))
+    x, y = wcs.all_world2pix(ra, dec, 0)
+    xc, yc = int(round(float(x))), int(round(float(y)))
+
+    image = band_data['image']
+    x0, x1 = max(0, xc - half), min(image.shape[1], xc + half + 1)
+    y0, y1 = max(0, yc - half), min(image.shape[0], yc + half + 1)
+
+    stamp_hdr = hdr.copy()
+    stamp_hdr['CRPIX1'] = hdr['CRPIX1'] - x0
+    stamp_hdr['CRPIX2'] = hdr['CRPIX2'] - y0
+    stamp = {
+        'image': image[y0:y1, x0:x1].copy(),
+        'hdr': stamp_hdr,
+        'metadata': dict(band_data['metadata']),
+    }
+    for plane in ('mask', 'variance'):
+        if plane in band_data:
+            stamp[plane] = band_data[plane][y0:y1, x0:x1].copy()
+    if 'mask_hdr' in band_data:
+        stamp['mask_hdr'] = band_data['mask_hdr']
+    return stamp
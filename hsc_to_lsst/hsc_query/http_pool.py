@@ -0,0 +1,229 @@
+"""
+Keep-alive HTTP(S) connections shared by `downloadCutout` and `downloadPsf`.
+
+`urllib.request.urlopen` opens (and closes) a new connection for every call,
+so each cutout request pays a TCP and TLS handshake.
+The pool defined here keeps idle connections open and reuses them
+for later requests to the same host.
+There is one pool per process: a pool inherited through `fork()`
+is discarded, because its sockets would be shared with the parent.
+"""
+import contextlib
+import http.client
+import io
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from typing import Dict, Generator, List, Optional, Tuple
+
+__all__ = ["ConnectionPool", "get_pool", "set_pool_size", "urlopen"]
+
+default_pool_size = 4
+default_timeout = 3600
+
+# Errors meaning that the server has closed an idle keep-alive connection.
+# A request failing with one of these on a reused connection is resent
+# on a fresh one.
+_stale_connection_errors = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+_Key = Tuple[str, str, Optional[int]]
+
+
+class ConnectionPool:
+    """
+    Pool of persistent HTTP(S) connections.
+
+    Parameters
+    ----------
+    pool_size
+        Maximum number of idle connections kept open per host.
+        More requests than this may be in flight at the same time;
+        the connections in excess are closed when they are released.
+    timeout
+        Default socket timeout, in seconds.
+    """
+    def __init__(self, pool_size: int = default_pool_size, timeout: float = default_timeout):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle: Dict[_Key, List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, key: _Key, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        """
+        Get an idle connection to `key`, or create a new one.
+
+        Returns
+        -------
+        conn
+            Connection.
+        reused
+            True if `conn` has already been used for another request.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _release(self, key: _Key, conn: http.client.HTTPConnection):
+        """
+        Return `conn` to the pool, or close it if the pool is full.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    @contextlib.contextmanager
+    def urlopen(self, req: urllib.request.Request, timeout: Optional[float] = None) -> Generator[http.client.HTTPResponse, None, None]:
+        """
+        Send `req` and yield the response.
+
+        This is a replacement of `urllib.request.urlopen()`
+        to be used in a `with` statement.
+        The response must be read within the `with` block.
+        When the block is exitted normally,
+        the rest of the response is discarded
+        and the connection goes back to the pool.
+
+        Parameters
+        ----------
+        req
+            Request.
+        timeout
+            Socket timeout, in seconds.
+
+        Returns
+        -------
+        contextmanager
+            Context manager yielding an `http.client.HTTPResponse`.
+
+        Raises
+        ------
+        urllib.error.HTTPError
+            If the server responds with a status other than 2xx.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        url = urllib.parse.urlsplit(req.full_url)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme: {req.full_url}")
+        key: _Key = (url.scheme, url.hostname or "", url.port)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        headers = dict(req.header_items())
+
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            try:
+                conn.request(req.get_method(), path, body=req.data, headers=headers)
+                resp = conn.getresponse()
+            except _stale_connection_errors:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            break
+
+        if not (200 <= resp.status < 300):
+            try:
+                body = resp.read()
+            finally:
+                conn.close()
+            raise urllib.error.HTTPError(req.full_url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+
+        try:
+            yield resp
+            # Discard what has not been read
+            # so that the next request can be sent on this connection.
+            resp.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_size = default_pool_size
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Get the connection pool of this process.
+
+    Returns
+    -------
+    pool
+        Connection pool.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        _pool = ConnectionPool(_pool_size)
+        _pool_pid = pid
+    return _pool
+
+
+def set_pool_size(pool_size: int):
+    """
+    Set the maximum number of idle connections kept open per host.
+
+    Parameters
+    ----------
+    pool_size
+        Pool size.
+    """
+    global _pool_size
+    if pool_size < 1:
+        raise ValueError(f"Pool size must be positive: {pool_size}")
+    _pool_size = pool_size
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.pool_size = pool_size
+
+
+def urlopen(req: urllib.request.Request, timeout: Optional[float] = None):
+    """
+    Send `req` using the connection pool of this process.
+
+    See `ConnectionPool.urlopen`.
+    """
+    return get_pool().urlopen(req, timeout)
@@ -0,0 +1,369 @@
+"""
+Cut-outs from HSC coadd patches stored on a local disk.
+
+The patches are the `calexp-{filter}-{tract}-{x},{y}.fits` files
+of an HSC data release, as laid out in the `deepCoadd-results` directory
+(`{filter}/{tract}/{x},{y}/calexp-{filter}-{tract}-{x},{y}.fits`),
+although only the file names matter.
+The headers of the patches are read once to build an index of their footprints;
+a cut-out is then sliced out of the memory-mapped image HDUs of the patches
+it overlaps, all of them in the same tract, which share a pixel grid.
+The mask and variance planes are the two HDUs following the image.
+"""
+import collections
+import dataclasses
+import os
+import pickle
+import re
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from typing import Dict, List, Optional, Tuple
+
+__all__ = ["LocalCoaddArchive"]
+
+# Maximum number of patch files kept open by each process
+max_open_files = 64
+
+_patch_file_re = re.compile(r"calexp-(?P<filter>[A-Za-z0-9_\-]+?)-(?P<tract>[0-9]+)-(?P<x>[0-9]+),(?P<y>[0-9]+)\.fits(\.fz)?")
+
+
+@dataclasses.dataclass
+class _Patch:
+    path: str
+    hdu: int
+    # Position of the pixel (0, 0) of the patch in the pixel grid of the tract
+    x0: int
+    y0: int
+    width: int
+    height: int
+
+
+@dataclasses.dataclass
+class _Tract:
+    filter: str
+    tract: int
+    # Header of the image HDU of the first patch, whose pixel grid is that of the tract
+    header: fits.Header
+    patches: List[_Patch]
+    wcs: WCS = dataclasses.field(default=None, repr=False)
+    # Unit vector of the center of the tract and the radius of a circle containing it, in radians
+    center: np.ndarray = dataclasses.field(default=None, repr=False)
+    radius: float = 0.0
+
+
+class LocalCoaddArchive:
+    """
+    Index of coadd patches on a local disk.
+
+    Parameters
+    ----------
+    root
+        Directory searched recursively for patch files.
+    index_path
+        File where the index is saved.
+        If it exists, it is loaded instead of reading the headers of the patches again.
+    rerun
+        Rerun name put in the metadata of the cut-outs.
+    """
+    def __init__(self, root: str, index_path: Optional[str] = None, rerun: str = "local"):
+        self.root = root
+        self.rerun = rerun
+        self._files: "collections.OrderedDict[str, fits.HDUList]" = collections.OrderedDict()
+        self._files_pid = os.getpid()
+
+        if index_path is not None and os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                self._tracts: Dict[str, List[_Tract]] = pickle.load(f)
+        else:
+            self._tracts = self._build_index()
+            if index_path is not None:
+                with open(index_path, "wb") as f:
+                    pickle.dump(self._tracts, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = collections.OrderedDict()
+        return state
+
+    @property
+    def filters(self) -> List[str]:
+        return sorted(self._tracts)
+
+    def _build_index(self) -> Dict[str, List[_Tract]]:
+        """
+        Read the headers of all the patches under `self.root`.
+
+        Returns
+        -------
+        tracts
+            Dictionary from filter names to lists of `_Tract`.
+        """
+        groups: Dict[Tuple[str, int], List[Tuple[str, int, fits.Header]]] = collections.defaultdict(list)
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in sorted(filenames):
+                m = _patch_file_re.fullmatch(filename)
+                if not m:
+                    continue
+                path = os.path.join(dirpath, filename)
+                hdu, header = _read_image_header(path)
+                groups[(m.group("filter"), int(m.group("tract")))].append((path, hdu, header))
+
+        tracts: Dict[str, List[_Tract]] = collections.defaultdict(list)
+        for (filter, tract), patch_headers in sorted(groups.items()):
+            ref_header = patch_headers[0][2]
+            patches = []
+            for path, hdu, header in patch_headers:
+                # Patches of a tract differ only by CRPIX
+                patches.append(_Patch(
+                    path=path,
+                    hdu=hdu,
+                    x0=int(round(ref_header["CRPIX1"] - header["CRPIX1"])),
+                    y0=int(round(ref_header["CRPIX2"] - header["CRPIX2"])),
+                    width=header["NAXIS1"],
+                    height=header["NAXIS2"],
+                ))
+            header = _strip_header(ref_header)
+            t = _Tract(filter=filter, tract=tract, header=header, patches=patches, wcs=WCS(header))
+            _set_bounding_circle(t)
+            tracts[filter].append(t)
+        return dict(tracts)
+
+    def _open(self, path: str) -> fits.HDUList:
+        """
+        Open a patch file, keeping recently used files open.
+        """
+        if self._files_pid != os.getpid():
+            # Do not share file objects with the parent process
+            self._files = collections.OrderedDict()
+            self._files_pid = os.getpid()
+        hdul = self._files.get(path)
+        if hdul is not None:
+            self._files.move_to_end(path)
+            return hdul
+        hdul = fits.open(path, memmap=True, lazy_load_hdus=True)
+        self._files[path] = hdul
+        if len(self._files) > max_open_files:
+            _, old = self._files.popitem(last=False)
+            old.close()
+        return hdul
+
+    def _find_tract(self, ra: float, dec: float, filter: str) -> Optional[Tuple[_Tract, float, float]]:
+        """
+        Find the tract in which a position is the farthest from the edges.
+
+        Returns
+        -------
+        tract
+            Tract, or None if no patch contains the position.
+        x, y
+            Position in the pixel grid of the tract.
+        """
+        v = _unit_vector(ra, dec)
+        best = None
+        best_margin = -np.inf
+        for t in self._tracts.get(filter, []):
+            if np.dot(v, t.center) < np.cos(t.radius):
+                continue
+            x, y = t.wcs.all_world2pix(ra, dec, 0)
+            if not any(p.x0 - 0.5 <= x < p.x0 + p.width - 0.5 and p.y0 - 0.5 <= y < p.y0 + p.height - 0.5
+                       for p in t.patches):
+                continue
+            margin = _tract_margin(t, x, y)
+            if margin > best_margin:
+                best, best_margin = (t, float(x), float(y)), margin
+        return best
+
+    def cutout(self, ra: float, dec: float, size: float, filter: str, planes: bool = False) -> Optional[dict]:
+        """
+        Cut a square out of the patches of a filter.
+
+        Parameters
+        ----------
+        ra, dec
+            Center of the cut-out, in degrees.
+        size
+            Width of the cut-out, in arcseconds.
+        filter
+            Filter name, e.g. "HSC-I".
+        planes
+            Whether to cut the mask and variance planes out too.
+
+        Returns
+        -------
+        data
+            Dictionary with keys "image", "hdr" and "metadata"
+            (and "mask", "mask_hdr" and "variance" if `planes`),
+            like the values of the output of `query.query_hsc`,
+            or None if no patch contains the position.
+            The image is clipped to the extent of the patches;
+            the pixels of the cut-out in no patch are NaN
+            (NO_DATA in the mask).
+        """
+        found = self._find_tract(ra, dec, filter)
+        if found is None:
+            return None
+        t, x, y = found
+
+        pix_scale = np.sqrt(np.abs(np.linalg.det(t.wcs.pixel_scale_matrix))) * 3600
+        half = int(round(size / 2 / pix_scale))
+        xc, yc = int(round(x)), int(round(y))
+        bx0, bx1 = xc - half, xc + half + 1
+        by0, by1 = yc - half, yc + half + 1
+
+        overlapping = [p for p in t.patches
+                       if p.x0 < bx1 and bx0 < p.x0 + p.width and p.y0 < by1 and by0 < p.y0 + p.height]
+        bx0 = max(bx0, min(p.x0 for p in overlapping))
+        bx1 = min(bx1, max(p.x0 + p.width for p in overlapping))
+        by0 = max(by0, min(p.y0 for p in overlapping))
+        by1 = min(by1, max(p.y0 + p.height for p in overlapping))
+
+        bbox = (bx0, bx1, by0, by1)
+        image = self._stitch(overlapping, 0, bbox, np.full((by1 - by0, bx1 - bx0), np.nan, dtype=np.float32))
+
+        hdr = t.header.copy()
+        for axis, offset in ((1, bx0), (2, by0)):
+            for key in (f"CRPIX{axis}", f"CRPIX{axis}A"):
+                if key in hdr:
+                    hdr[key] -= offset
+            if f"LTV{axis}" in hdr:
+                hdr[f"LTV{axis}"] -= offset
+
+        metadata = {
+            "lineno": None,
+            "type": "coadd",
+            "filter": filter,
+            "tract": t.tract,
+            "rerun": self.rerun,
+        }
+        data = {"image": image, "hdr": hdr, "metadata": metadata}
+        if planes:
+            mask_hdr = _strip_header(self._open(overlapping[0].path)[overlapping[0].hdu + 1].header)
+            no_data = 1 << mask_hdr["MP_NO_DATA"] if "MP_NO_DATA" in mask_hdr else 0
+            data["mask"] = self._stitch(overlapping, 1, bbox,
+                                        np.full(image.shape, no_data, dtype=np.int32))
+            data["mask_hdr"] = mask_hdr
+            data["variance"] = self._stitch(overlapping, 2, bbox,
+                                            np.full(image.shape, np.nan, dtype=np.float32))
+        return data
+
+    def _stitch(self, patches: List[_Patch], plane: int, bbox: Tuple[int, int, int, int],
+                out: np.ndarray) -> np.ndarray:
+        """
+        Copy the pixels of a plane of the patches into `out`.
+
+        Parameters
+        ----------
+        patches
+            Patches overlapping `bbox`.
+        plane
+            0 for the image, 1 for the mask, 2 for the variance.
+        bbox
+            `(x0, x1, y0, y1)`: pixels of the tract covered by `out`.
+        out
+            Output array, filled where there is no patch.
+
+        Returns
+        -------
+        out
+            The output array.
+        """
+        bx0, bx1, by0, by1 = bbox
+        for p in patches:
+            ix0, ix1 = max(bx0, p.x0), min(bx1, p.x0 + p.width)
+            iy0, iy1 = max(by0, p.y0), min(by1, p.y0 + p.height)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            data = self._open(p.path)[p.hdu + plane].data
+            out[iy0 - by0:iy1 - by0, ix0 - bx0:ix1 - bx0] = data[iy0 - p.y0:iy1 - p.y0, ix0 - p.x0:ix1 - p.x0]
+        return out
+
+    def query(self, ra: float, dec: float, size: float, planes: bool = False) -> Dict[str, dict]:
+        """
+        Cut an object out of the patches of the five broad bands.
+
+        Parameters
+        ----------
+        ra, dec
+            Center of the cut-out, in degrees.
+        size
+            Width of the cut-out, in arcseconds.
+        planes
+            Whether to cut the mask and variance planes out too.
+
+        Returns
+        -------
+        hsc_data
+            Same structure as the output of `query.query_hsc`.
+            The dictionary of a band is empty if there is no data in it.
+        """
+        output_data = {}
+        for band in 'grizy':
+            output_data[band] = self.cutout(ra, dec, size, f"HSC-{band.upper()}", planes) or {}
+        return output_data
+
+
+def _read_image_header(path: str) -> Tuple[int, fits.Header]:
+    """
+    Find the first image HDU of a patch file.
+
+    Returns
+    -------
+    hdu
+        Index of the HDU.
+    header
+        Header of the HDU.
+    """
+    with fits.open(path, memmap=True, lazy_load_hdus=True) as hdul:
+        for i, hdu in enumerate(hdul):
+            if hdu.header.get("NAXIS", 0) == 2 or hdu.header.get("ZNAXIS", 0) == 2:
+                header = hdu.header.copy()
+                if "ZNAXIS1" in header:
+                    header["NAXIS1"], header["NAXIS2"] = header["ZNAXIS1"], header["ZNAXIS2"]
+                return i, header
+    raise ValueError(f"No image in {path}")
+
+
+def _strip_header(header: fits.Header) -> fits.Header:
+    """
+    Remove the structural keywords of an HDU header.
+    """
+    header = header.copy()
+    for key in ("XTENSION", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "PCOUNT", "GCOUNT", "EXTEND",
+                "ZIMAGE", "ZBITPIX", "ZNAXIS", "ZNAXIS1", "ZNAXIS2", "ZTILE1", "ZTILE2", "ZCMPTYPE"):
+        header.remove(key, ignore_missing=True, remove_all=True)
+    return header
+
+
+def _unit_vector(ra, dec) -> np.ndarray:
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _set_bounding_circle(t: _Tract):
+    """
+    Compute a circle on the sky containing all the patches of a tract.
+    """
+    wcs = t.wcs
+    xs, ys = [], []
+    for p in t.patches:
+        xs += [p.x0 - 0.5, p.x0 + p.width - 0.5]
+        ys += [p.y0 - 0.5, p.y0 + p.height - 0.5]
+    x0, x1, y0, y1 = min(xs), max(xs), min(ys), max(ys)
+    corners = np.array(wcs.all_pix2world([x0, x1, x1, x0, (x0 + x1) / 2], [y0, y0, y1, y1, (y0 + y1) / 2], 0)).T
+    vectors = _unit_vector(corners[:, 0], corners[:, 1])
+    t.center = vectors[-1]
+    t.radius = float(np.max(np.arccos(np.clip(vectors[:-1] @ t.center, -1, 1)))) * 1.01
+
+
+def _tract_margin(t: _Tract, x: float, y: float) -> float:
+    """
+    Distance, in pixels, from a position to the edge of the bounding box of a tract.
+    """
+    x0 = min(p.x0 for p in t.patches)
+    x1 = max(p.x0 + p.width for p in t.patches) - 1
+    y0 = min(p.y0 for p in t.patches)
+    y1 = max(p.y0 + p.height for p in t.patches) - 1
+    return min(x - x0, x1 - x, y - y0, y1 - y)
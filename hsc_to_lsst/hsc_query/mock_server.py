@@ -0,0 +1,421 @@
+"""
+Local stand-in for the DAS cutout and PSF servers, for offline benchmarking.
+
+The server speaks the same protocol as the real ones:
+a multipart POST of a coordinate list to `/das_cutout/pdr3/cgi-bin/cutout`
+or `/psf/pdr3/cgi/getpsf`, answered by a tar stream whose member names are
+those parsed by `downloadCutout._tar_decompose_item_name` and
+`downloadPsf._tar_decompose_item_name`.
+The members are synthetic FITS files: a noisy galaxy for cut-outs,
+a Gaussian for PSFs.
+Latency, bandwidth and failures can be injected.
+
+Example
+-------
+    with MockDasServer(latency=0.2, bandwidth=5e6) as server:
+        server.install()  # point downloadCutout and downloadPsf at the server
+        ...
+
+or, from a shell (then pass --hsc_api_url to degrade_hsc):
+    python -m hsc_to_lsst.hsc_query.mock_server --port 8080 --latency 0.2
+"""
+import argparse
+import http.server
+import io
+import random
+import re
+import tarfile
+import threading
+import time
+import zlib
+
+import numpy as np
+from astropy.io import fits
+
+from hsc_to_lsst.hsc_query import downloadCutout, downloadPsf
+from hsc_to_lsst.hsc_query.skymap import hsc_skymap
+
+from typing import Dict, List, Optional
+
+__all__ = ["MockDasServer"]
+
+cutout_path = "/das_cutout/pdr3"
+psf_path = "/psf/pdr3"
+
+hsc_pix_scale = 0.168
+hsc_zero_point = 27.0
+mock_fwhm = 0.7
+
+# Filters for which the mock server has data
+mock_filters = ["HSC-G", "HSC-R", "HSC-I", "HSC-Z", "HSC-Y"]
+
+# Mask planes written in the MASK HDU, as in the HSC pipeline
+mask_planes = {
+    "BAD": 0, "SAT": 1, "INTRP": 2, "CR": 3, "EDGE": 4, "DETECTED": 5,
+    "DETECTED_NEGATIVE": 6, "SUSPECT": 7, "NO_DATA": 8,
+}
+
+
+class MockDasServer:
+    """
+    Mock DAS server running in a background thread.
+
+    Parameters
+    ----------
+    host
+        Host to bind.
+    port
+        Port to bind. If 0, a free port is chosen.
+    latency
+        Time, in seconds, before the server starts to respond to a request.
+    bandwidth
+        Maximum throughput of each response, in bytes per second.
+        If None, there is no limit.
+    error_rate
+        Probability that a request is answered with "503 Service Unavailable".
+    truncate_rate
+        Probability that a response is cut in the middle of the tar stream.
+    noise_rms
+        Standard deviation of the background noise of the cut-outs.
+    seed
+        Seed of the random number generator used for error injection.
+        The images depend only on the requested coordinates and filter.
+    """
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            *,
+            latency: float = 0.0,
+            bandwidth: Optional[float] = None,
+            error_rate: float = 0.0,
+            truncate_rate: float = 0.0,
+            noise_rms: float = 0.05,
+            seed: Optional[int] = None
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.noise_rms = noise_rms
+        self.random = random.Random(seed)
+        self.num_requests = 0
+        self.num_items = 0
+        self.num_bytes = 0
+        self._lock = threading.Lock()
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def cutout_url(self) -> str:
+        """URL to be used as `downloadCutout.api_url`."""
+        return self.url + cutout_path
+
+    @property
+    def psf_url(self) -> str:
+        """URL to be used as `downloadPsf.api_url`."""
+        return self.url + psf_path
+
+    def install(self):
+        """
+        Point `downloadCutout.api_url` and `downloadPsf.api_url` at this server.
+        """
+        downloadCutout.api_url = self.cutout_url
+        downloadPsf.api_url = self.psf_url
+
+    def start(self) -> "MockDasServer":
+        """
+        Start serving in a background thread.
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve_forever(self):
+        """
+        Serve in the calling thread.
+        """
+        self._httpd.serve_forever()
+
+    def __enter__(self) -> "MockDasServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, num_items: int, num_bytes: int):
+        with self._lock:
+            self.num_requests += 1
+            self.num_items += num_items
+            self.num_bytes += num_bytes
+
+
+def _make_handler(server: MockDasServer):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            path = self.path.split("?", 1)[0]
+            if path == cutout_path + "/cgi-bin/cutout":
+                make_items = _cutout_items
+            elif path == psf_path + "/cgi/getpsf":
+                make_items = _psf_items
+            else:
+                self._send_error(404, "Not Found")
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.headers.get("Authorization", "").startswith("Basic "):
+                self._send_error(401, "Unauthorized")
+                return
+
+            time.sleep(server.latency)
+            if server.random.random() < server.error_rate:
+                self._send_error(503, "Service Unavailable")
+                server._count(0, 0)
+                return
+
+            rows = _parse_coordlist(body)
+            truncate = server.random.random() < server.truncate_rate
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-tar")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            writer = _ChunkedWriter(self.wfile, server.bandwidth)
+            num_items = 0
+            try:
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    for lineno, row in enumerate(rows, start=2):
+                        for name, data in make_items(lineno, row, server):
+                            if truncate and server.random.random() < 0.5:
+                                writer.write(data[: len(data) // 2])
+                                self.close_connection = True
+                                return
+                            info = tarfile.TarInfo(name)
+                            info.size = len(data)
+                            info.mtime = int(time.time())
+                            tar.addfile(info, io.BytesIO(data))
+                            num_items += 1
+                writer.close()
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+            finally:
+                server._count(num_items, writer.num_bytes)
+
+        def _send_error(self, code: int, message: str):
+            content = message.encode("utf-8")
+            self.send_response(code, message)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return Handler
+
+
+class _ChunkedWriter:
+    """
+    File-like object writing HTTP chunks at a limited rate.
+    """
+    def __init__(self, wfile, bandwidth: Optional[float]):
+        self.wfile = wfile
+        self.bandwidth = bandwidth
+        self.num_bytes = 0
+        self._start = time.monotonic()
+
+    def write(self, data: bytes) -> int:
+        if not data:
+            return 0
+        self.wfile.write(b"%x\r\n" % len(data) + bytes(data) + b"\r\n")
+        self.wfile.flush()
+        self.num_bytes += len(data)
+        if self.bandwidth:
+            delay = self.num_bytes / self.bandwidth - (time.monotonic() - self._start)
+            if delay > 0:
+                time.sleep(delay)
+        return len(data)
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def _parse_coordlist(body: bytes) -> List[Dict[str, str]]:
+    """
+    Extract the rows of the coordinate list from a multipart request body.
+    """
+    text = body.decode("utf-8")
+    m = re.search(r"^#\??\s*(.*)$", text, re.MULTILINE)
+    if not m:
+        return []
+    fieldnames = m.group(1).split()
+    rows = []
+    for line in text[m.end():].splitlines():
+        if not line.strip() or line.startswith("--"):
+            continue
+        values = line.split()
+        if len(values) != len(fieldnames):
+            continue
+        rows.append(dict(zip(fieldnames, values)))
+    return rows
+
+
+def _angle(s: str) -> float:
+    return downloadCutout.parse_degree(s)
+
+
+def _seed(*values) -> int:
+    return zlib.crc32(" ".join(str(v) for v in values).encode("utf-8"))
+
+
+def _cutout_items(lineno: int, row: Dict[str, str], server: MockDasServer):
+    """
+    Make the tar members answering a line of a cut-out request.
+    """
+    if row.get("filter") not in mock_filters or row.get("type") == "warp":
+        return
+    ra, dec = _angle(row["ra"]), _angle(row["dec"])
+    # Like the real server, answer with every tract containing the position
+    # unless a tract is specified
+    tracts = hsc_skymap.find_overlapping_tracts(ra, dec)
+    if row.get("tract", "any") != "any":
+        tracts = [int(row["tract"])] if int(row["tract"]) in tracts else []
+    type_name = "coadd+bg" if row.get("type") == "coadd/bg" else "cutout"
+    for tract in tracts:
+        name = f"arch-{lineno}-0/{lineno}-{type_name}-{row['filter']}-{tract}-{row['rerun']}.fits"
+        yield name, _synthetic_cutout(
+            ra, dec, _angle(row["sw"]), _angle(row["sh"]), row["filter"], server.noise_rms,
+            with_mask=row.get("mask") == "true",
+            with_variance=row.get("variance") == "true",
+        )
+
+
+def _psf_items(lineno: int, row: Dict[str, str], server: MockDasServer):
+    """
+    Make the tar members answering a line of a PSF request.
+    """
+    if row.get("filter") not in mock_filters or row.get("type") == "warp":
+        return
+    ra, dec = _angle(row["ra"]), _angle(row["dec"])
+    tract = hsc_skymap.find_tract(ra, dec) if row.get("tract", "auto") == "auto" else int(row["tract"])
+    patch = "4,4" if row.get("patch", "auto") == "auto" else row["patch"]
+    name = f"{lineno}-psf-calexp-{row['rerun']}-{row['filter']}-{tract}-{patch}-{ra:.5f}-{dec:.5f}.fits"
+    yield name, _synthetic_psf()
+
+
+def _wcs_header(ra: float, dec: float, shape) -> fits.Header:
+    hdr = fits.Header()
+    hdr["CTYPE1"] = "RA---TAN"
+    hdr["CTYPE2"] = "DEC--TAN"
+    hdr["CRVAL1"] = ra
+    hdr["CRVAL2"] = dec
+    hdr["CRPIX1"] = (shape[1] + 1) / 2
+    hdr["CRPIX2"] = (shape[0] + 1) / 2
+    hdr["CD1_1"] = -hsc_pix_scale / 3600
+    hdr["CD1_2"] = 0.0
+    hdr["CD2_1"] = 0.0
+    hdr["CD2_2"] = hsc_pix_scale / 3600
+    return hdr
+
+
+def _synthetic_cutout(ra, dec, sw, sh, filter, noise_rms, with_mask=False, with_variance=False) -> bytes:
+    """
+    Make a FITS file with a noisy galaxy at the center.
+    """
+    nx = 2 * int(round(sw * 3600 / hsc_pix_scale)) + 1
+    ny = 2 * int(round(sh * 3600 / hsc_pix_scale)) + 1
+    rng = np.random.default_rng(_seed(f"{ra:.7f}", f"{dec:.7f}", filter))
+
+    y, x = np.mgrid[:ny, :nx]
+    r = np.hypot(x - (nx - 1) / 2, y - (ny - 1) / 2)
+    r_eff = rng.uniform(2, 8)
+    galaxy = rng.uniform(5, 50) * np.exp(-7.67 * ((r / r_eff) ** 0.25 - 1)) / np.exp(7.67)
+    sigma = mock_fwhm / hsc_pix_scale / 2.355
+    galaxy = galaxy + rng.uniform(1, 10) * np.exp(-r**2 / (2 * sigma**2))
+    image = (galaxy + rng.normal(0, noise_rms, size=(ny, nx))).astype(np.float32)
+
+    hdr = _wcs_header(ra, dec, image.shape)
+    hdr["FLUXMAG0"] = 10 ** (0.4 * hsc_zero_point)
+    hdr["EXTNAME"] = "IMAGE"
+    hdus = [fits.PrimaryHDU(), fits.ImageHDU(image, header=hdr)]
+    if with_mask:
+        mask_hdr = _wcs_header(ra, dec, image.shape)
+        mask_hdr["EXTNAME"] = "MASK"
+        for plane, bit in mask_planes.items():
+            mask_hdr[f"HIERARCH MP_{plane}"] = bit
+        mask = np.where(galaxy > 3 * noise_rms, 1 << mask_planes["DETECTED"], 0).astype(np.int32)
+        hdus.append(fits.ImageHDU(mask, header=mask_hdr))
+    if with_variance:
+        var_hdr = _wcs_header(ra, dec, image.shape)
+        var_hdr["EXTNAME"] = "VARIANCE"
+        variance = np.full(image.shape, noise_rms**2, dtype=np.float32)
+        hdus.append(fits.ImageHDU(variance, header=var_hdr))
+
+    buffer = io.BytesIO()
+    fits.HDUList(hdus).writeto(buffer)
+    return buffer.getvalue()
+
+
+def _synthetic_psf(size: int = 43) -> bytes:
+    """
+    Make a FITS file with a centered Gaussian PSF.
+    """
+    sigma = mock_fwhm / hsc_pix_scale / 2.355
+    y, x = np.mgrid[:size, :size]
+    psf = np.exp(-((x - size // 2) ** 2 + (y - size // 2) ** 2) / (2 * sigma**2))
+    buffer = io.BytesIO()
+    fits.PrimaryHDU((psf / psf.sum()).astype(np.float32)).writeto(buffer)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock DAS cutout/PSF server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8080, help="Port to bind")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency of each request, in seconds")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bandwidth of each response, in bytes/s")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests failing with 503")
+    parser.add_argument("--truncate_rate", type=float, default=0.0, help="Fraction of responses cut in the middle")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the error injection")
+    args = parser.parse_args()
+
+    server = MockDasServer(
+        args.host,
+        args.port,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        truncate_rate=args.truncate_rate,
+        seed=args.seed,
+    )
+    print(f"Cutout API: {server.cutout_url}")
+    print(f"PSF API:    {server.psf_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Spatial ordering of a catalog before it is sent to the DAS server.
+
+The server reads the coadd patches a cut-out overlaps,
+and keeps recently read patches in its cache.
+Requesting the objects of a catalog in file order makes consecutive requests
+hit random tracts; requesting them patch by patch makes them hit the cache.
+The objects are grouped by HSC tract (see `skymap`),
+and in sub-cells of about the size of a patch within each tract.
+"""
+import numpy as np
+
+from hsc_to_lsst.hsc_query.skymap import hsc_skymap, patch_size
+
+from typing import List, Sequence
+
+__all__ = ["spatial_order", "plan_batches", "restore_order"]
+
+# A tract has about 9x9 patches
+patches_per_tract = 9
+
+
+def cell_ids(ra: Sequence[float], dec: Sequence[float]) -> np.ndarray:
+    """
+    Compute the tracts and patch-sized cells of positions.
+
+    Parameters
+    ----------
+    ra
+        Right ascensions in degrees.
+    dec
+        Declinations in degrees.
+
+    Returns
+    -------
+    cells
+        Integer array of shape (N, 3): tract,
+        row and column of the patch-sized cell in the tract.
+    """
+    ra = np.mod(np.asarray(ra, dtype=float), 360.0)
+    dec = np.asarray(dec, dtype=float)
+
+    tracts = hsc_skymap.find_tracts(ra, dec)
+    unique_tracts, inverse = np.unique(tracts, return_inverse=True)
+    centers = np.array([hsc_skymap.tract_center(int(t)) for t in unique_tracts]).reshape(-1, 2)[inverse.ravel()]
+    # Offsets from the center of the tract, in patches
+    x = ((ra - centers[:, 0] + 180.0) % 360.0 - 180.0) * np.cos(np.radians(dec)) * 3600 / patch_size
+    y = (dec - centers[:, 1]) * 3600 / patch_size
+
+    row = np.clip(np.floor(y + patches_per_tract / 2), 0, patches_per_tract - 1).astype(int)
+    col = np.clip(np.floor(x + patches_per_tract / 2), 0, patches_per_tract - 1).astype(int)
+    return np.stack([tracts, row, col], axis=-1)
+
+
+def spatial_order(ra: Sequence[float], dec: Sequence[float]) -> np.ndarray:
+    """
+    Order positions tract by tract, and patch-sized cell by cell.
+
+    Within a sub-cell, the positions are ordered by right ascension.
+
+    Parameters
+    ----------
+    ra
+        Right ascensions in degrees.
+    dec
+        Declinations in degrees.
+
+    Returns
+    -------
+    order
+        Indices of the positions in the order in which to request them.
+    """
+    cells = cell_ids(ra, dec)
+    ra = np.mod(np.asarray(ra, dtype=float), 360.0)
+    # np.lexsort sorts by the last key first
+    return np.lexsort((ra, cells[:, 2], cells[:, 1], cells[:, 0]))
+
+
+def plan_batches(ra: Sequence[float], dec: Sequence[float], batch_size: int) -> List[List[int]]:
+    """
+    Split a catalog into batches of nearby objects.
+
+    Parameters
+    ----------
+    ra
+        Right ascensions in degrees.
+    dec
+        Declinations in degrees.
+    batch_size
+        Maximum number of objects in a batch.
+
+    Returns
+    -------
+    batches
+        Lists of indices into the catalog,
+        in the order in which they should be requested.
+    """
+    order = spatial_order(ra, dec).tolist()
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def restore_order(batches: List[List[int]], results: List[list]) -> list:
+    """
+    Put the results of batches back in catalog order.
+
+    Parameters
+    ----------
+    batches
+        Batches returned by `plan_batches`.
+    results
+        `results[i][j]` is the result for the object `batches[i][j]`.
+
+    Returns
+    -------
+    results
+        The results, indexed by position in the catalog.
+    """
+    out = [None] * sum(len(batch) for batch in batches)
+    for batch, batch_results in zip(batches, results):
+        for index, result in zip(batch, batch_results):
+            out[index] = result
+    return out
@@ -1,46 +1,275 @@
-from hsc_to_lsst.hsc_query import downloadCutout  # , downloadPsf
-from astropy.io import fits
-import io
+from hsc_to_lsst.hsc_query import downloadCutout, downloadPsf
+from hsc_to_lsst.hsc_query.fits_decode import decode_image, decode_images
+from hsc_to_lsst.hsc_query.grouping import TargetGroup, group_targets, slice_stamp, default_max_group_size
+from hsc_to_lsst.hsc_query.skymap import find_tract
 import os
 
 
-def query_hsc(ra, dec, semaphore, username=None, password=None, size=20, field="pdr3_wide"):
-
+def _get_credentials(username, password):
     if username is None:
         username = os.environ.get('HSC_SSP_CAS_USERNAME')
     if password is None:
         password = os.environ.get('HSC_SSP_CAS_PASSWORD')
+    return username, password
+
 
-    rect = downloadCutout.Rect.create(
+def _make_rect(ra, dec, size, field, band="all", tract=downloadCutout.ANYTRACT, planes=False):
+    return downloadCutout.Rect.create(
         ra=str(ra),
         dec=str(dec),
         sw=f"{size/2}arcsec",
         sh=f"{size/2}arcsec",
-        filter="all",
-        rerun=field
+        filter=band,
+        tract=tract,
+        rerun=field,
+        mask=planes,
+        variance=planes
     )
-    # psf_req = downloadPsf.PsfRequest.create(
-    #     ra=str(ra),
-    #     dec=str(dec),
-    #     filter="all",
-    #     rerun=field,
-    # )
-    image_list = downloadCutout.download(rect, user=username, password=password, semaphore=semaphore)
-    # with lock:
-    #     psf_list = downloadPsf.download(psf_req, user=username, password=password)
 
+
+def _make_band_rects(ra, dec, size, field, planes=False):
+    # one rect per band, so that the server is not asked for the other filters,
+    # in the tract of the object, so that it does not send the overlapping tracts too
+    rects = []
+    for ra_i, dec_i in zip(ra, dec):
+        tract = find_tract(ra_i, dec_i)
+        rects.extend(_make_rect(ra_i, dec_i, size, field, band, tract, planes) for band in 'grizy')
+    return rects
+
+
+def _make_group_rects(groups, field, planes=False):
+    rects = []
+    for group in groups:
+        tract = find_tract(group.ra, group.dec)
+        rects.extend(_make_rect(group.ra, group.dec, group.size, field, band, tract, planes) for band in 'grizy')
+    return rects
+
+
+def _any_tract(rects):
+    return [downloadCutout.Rect.create(tract=downloadCutout.ANYTRACT, default=rect) for rect in rects]
+
+
+def _download_rects(rects, username, password, semaphore, cache):
+    # rects for which the tract given by the skymap has no data (e.g. at the edge of the survey)
+    # are sent again with any tract
+    image_lists = downloadCutout.download(rects, user=username, password=password, semaphore=semaphore,
+                                          cache=cache)
+    missing = [i for i, image_list in enumerate(image_lists) if not image_list]
+    if missing:
+        retried = downloadCutout.download(_any_tract([rects[i] for i in missing]), user=username,
+                                          password=password, semaphore=semaphore, cache=cache)
+        for i, image_list in zip(missing, retried):
+            image_lists[i] = image_list
+    return image_lists
+
+
+def _make_groups(ra, dec, size, merge_targets, max_group_size):
+    if merge_targets:
+        return group_targets(ra, dec, size, max_group_size)
+    return [TargetGroup([i], ra_i, dec_i, size) for i, (ra_i, dec_i) in enumerate(zip(ra, dec))]
+
+
+def _split_group(group, group_data, ra, dec, size):
+    # yield `(i, hsc_data)` for the members of a group
+    if len(group.members) == 1:
+        yield group.members[0], group_data
+        return
+    for i in group.members:
+        yield i, {band: slice_stamp(band_data, ra[i], dec[i], size) if band_data else {}
+                  for band, band_data in group_data.items()}
+
+
+def _join_objects(lists):
+    # join the five per-band lists of each object made by `_make_band_rects` or `_make_band_psfreqs`
+    return [[item for band_list in lists[i:i + 5] for item in band_list] for i in range(0, len(lists), 5)]
+
+
+def _split_objects(image_lists, psf_lists=None):
+    image_lists = _join_objects(image_lists)
+    if psf_lists is None:
+        return [_split_bands(image_list) for image_list in image_lists]
+    return [_split_bands(image_list, psf_list) for image_list, psf_list in zip(image_lists, psf_lists)]
+
+
+def _split_bands(image_list, psf_list=None):
     output_data = {}
     for band in 'grizy':
         band_data = {}
         for metadata, data in image_list:
             if metadata['filter'] == f"HSC-{band.upper()}":
-                band_data['image'], band_data['hdr'] = fits.getdata(io.BytesIO(data), header=True)
+                # `hdr` is a `fits_decode.LazyHeader`
+                (band_data['image'], band_data['hdr']), *planes = decode_images(data)
+                for plane, plane_hdr in planes:
+                    if plane_hdr.get('EXTNAME') == 'MASK':
+                        band_data['mask'], band_data['mask_hdr'] = plane, plane_hdr
+                    elif plane_hdr.get('EXTNAME') == 'VARIANCE':
+                        band_data['variance'] = plane
                 band_data['metadata'] = metadata
                 break
-        # for psf_metadata, psf_data in psf_list:
-        #     if psf_metadata['filter'] == f"HSC-{filter_name.upper()}":
-        #         psf = fits.getdata(io.BytesIO(psf_data))
-        #         filter_data['psf'] = psf
-        #         break
         output_data[band] = band_data
+    if psf_list is not None:
+        _add_psfs(output_data, psf_list)
     return output_data
+
+
+def _add_psfs(hsc_data, psf_list):
+    for band in 'grizy':
+        if not hsc_data[band]:
+            continue
+        for psf_metadata, psf_data in psf_list:
+            if psf_metadata['filter'] == f"HSC-{band.upper()}":
+                hsc_data[band]['psf'] = decode_image(psf_data)[0]
+                break
+
+
+def _make_band_psfreqs(ra, dec, field):
+    psfreqs = []
+    for ra_i, dec_i in zip(ra, dec):
+        psfreqs.extend(downloadPsf.PsfRequest.create(ra=str(ra_i), dec=str(dec_i), filter=band, rerun=field)
+                       for band in 'grizy')
+    return psfreqs
+
+
+def _query_psfs(ra, dec, semaphore, username, password, field, psf_cache):
+    # PSFs of several objects in a single batched request, one list per object
+    psfreqs = _make_band_psfreqs(ra, dec, field)
+    psf_lists = downloadPsf.download(psfreqs, user=username, password=password, semaphore=semaphore,
+                                     cache=psf_cache)
+    return _join_objects(psf_lists)
+
+
+def query_hsc(ra, dec, semaphore, username=None, password=None, size=20, field="pdr3_wide", cache=None,
+              local_coadd=None, use_psf=False, psf_cache=None, use_planes=False):
+    """
+    Cut an object out of the five broad bands.
+
+    The cutouts are requested in the tract given by `skymap.find_tract`,
+    so that the server sends a single image per band where tracts overlap.
+    If `local_coadd` (a `local_coadd.LocalCoaddArchive`) is given,
+    the cutouts are sliced out of the coadd patches on disk instead of being downloaded.
+    If `use_psf`, the coadd PSF of each band is downloaded too, as `hsc_data[band]['psf']`;
+    `psf_cache` is a `cache.PsfCache` shared by neighbouring objects.
+    If `use_planes`, the mask and variance planes are downloaded too,
+    as `hsc_data[band]['mask']` (with its header `hsc_data[band]['mask_hdr']`)
+    and `hsc_data[band]['variance']`.
+    """
+    username, password = _get_credentials(username, password)
+
+    psf_list = None
+    if use_psf:
+        psf_list, = _query_psfs([ra], [dec], semaphore, username, password, field, psf_cache)
+
+    if local_coadd is not None:
+        hsc_data = local_coadd.query(ra, dec, size, use_planes)
+        if psf_list is not None:
+            _add_psfs(hsc_data, psf_list)
+        return hsc_data
+
+    rects = _make_band_rects([ra], [dec], size, field, use_planes)
+    image_lists = _download_rects(rects, username, password, semaphore, cache)
+
+    hsc_data = _split_objects(image_lists)[0]
+    if psf_list is not None:
+        _add_psfs(hsc_data, psf_list)
+    return hsc_data
+
+
+def query_hsc_batch(ra, dec, semaphore, username=None, password=None, size=20, field="pdr3_wide", cache=None,
+                    local_coadd=None, use_psf=False, psf_cache=None, merge_targets=False,
+                    max_group_size=default_max_group_size, use_planes=False):
+    """
+    Query several objects with as few requests to the server as possible.
+
+    All the cutouts are sent in a single call to `downloadCutout.download`,
+    which packs up to `downloadCutout.max_chunksize` (990) exploded rects into each POST request.
+    Each object (or group of merged targets) makes one rect per band of grizy,
+    so up to 198 objects share a request; the bands missing from the tract
+    given by `skymap.find_tract` are asked for again, in any tract, by another request.
+    The returned list follows the order of `ra` and `dec`,
+    each element having the same structure as the output of `query_hsc`.
+    The PSFs, if `use_psf`, are also downloaded with a single query.
+    If `merge_targets`, objects whose cutouts overlap are downloaded
+    as a single cutout, at most `max_group_size` arcsec wide,
+    out of which their cutouts are sliced (see `grouping.group_targets`).
+    The mask and variance planes are downloaded too if `use_planes`.
+    """
+    username, password = _get_credentials(username, password)
+
+    psf_lists = None
+    if use_psf:
+        psf_lists = _query_psfs(ra, dec, semaphore, username, password, field, psf_cache)
+
+    if local_coadd is not None:
+        hsc_data_list = [local_coadd.query(ra_i, dec_i, size, use_planes) for ra_i, dec_i in zip(ra, dec)]
+    else:
+        groups = _make_groups(ra, dec, size, merge_targets, max_group_size)
+        rects = _make_group_rects(groups, field, use_planes)
+        image_lists = _download_rects(rects, username, password, semaphore, cache)
+        hsc_data_list = [None] * len(ra)
+        for group, group_data in zip(groups, _split_objects(image_lists)):
+            for i, hsc_data in _split_group(group, group_data, ra, dec, size):
+                hsc_data_list[i] = hsc_data
+
+    if psf_lists is not None:
+        for hsc_data, psf_list in zip(hsc_data_list, psf_lists):
+            _add_psfs(hsc_data, psf_list)
+    return hsc_data_list
+
+
+def iter_query_hsc_batch(ra, dec, semaphore, username=None, password=None, size=20, field="pdr3_wide", cache=None,
+                         local_coadd=None, use_psf=False, psf_cache=None, merge_targets=False,
+                         max_group_size=default_max_group_size, use_planes=False):
+    """
+    Streaming version of `query_hsc_batch`.
+
+    Yields `(i, hsc_data)` for the i-th object as soon as its five bands
+    (or those of its group, if `merge_targets`)
+    have been read from the server, so that it can be processed
+    while the rest of the response is still being downloaded.
+    Objects for which some band is missing are yielded at the end.
+    The PSFs, if `use_psf`, are downloaded before the cutouts.
+    """
+    username, password = _get_credentials(username, password)
+
+    psf_lists = [None] * len(ra)
+    if use_psf:
+        psf_lists = _query_psfs(ra, dec, semaphore, username, password, field, psf_cache)
+
+    def with_psf(i, hsc_data):
+        if psf_lists[i] is not None:
+            _add_psfs(hsc_data, psf_lists[i])
+        return i, hsc_data
+
+    if local_coadd is not None:
+        for i, (ra_i, dec_i) in enumerate(zip(ra, dec)):
+            yield with_psf(i, local_coadd.query(ra_i, dec_i, size, use_planes))
+        return
+
+    groups = _make_groups(ra, dec, size, merge_targets, max_group_size)
+    rects = _make_group_rects(groups, field, use_planes)
+    bands = {f"HSC-{band.upper()}" for band in 'grizy'}
+    received = [[] for _ in range(len(groups))]
+    done = [False] * len(groups)
+    for index, metadata, data in downloadCutout.iter_download(rects, user=username, password=password,
+                                                              semaphore=semaphore, cache=cache):
+        index //= 5
+        if done[index]:
+            continue
+        received[index].append((metadata, data))
+        if {m['filter'] for m, _ in received[index]} == bands:
+            done[index] = True
+            for i, hsc_data in _split_group(groups[index], _split_bands(received[index]), ra, dec, size):
+                yield with_psf(i, hsc_data)
+            received[index] = []
+    incomplete = [index for index in range(len(groups)) if not done[index]]
+    missing = [index * 5 + b for index in incomplete for b, band in enumerate('grizy')
+               if f"HSC-{band.upper()}" not in {m['filter'] for m, _ in received[index]}]
+    if missing:
+        # the tract given by the skymap has no data in these bands
+        retried = downloadCutout.download(_any_tract([rects[k] for k in missing]), user=username,
+                                          password=password, semaphore=semaphore, cache=cache)
+        for k, image_list in zip(missing, retried):
+            received[k // 5].extend(image_list)
+    for index in incomplete:
+        for i, hsc_data in _split_group(groups[index], _split_bands(received[index]), ra, dec, size):
+            yield with_psf(i, hsc_data)
@@ -0,0 +1,186 @@
+"""
+Geometry of the HSC-SSP sky map, to find tracts without asking the server.
+
+The HSC-SSP data releases use a "rings" sky map (`lsst.skymap.RingsSkyMap`
+with 120 rings and no RA offset): the sky is cut into declination rings
+of equal height, each divided into tracts of about equal width in RA,
+plus a tract at each pole.
+Tracts overlap a little, and every position is in the tract
+in whose cell (ring and RA slice) it falls, with the largest margin.
+"""
+import math
+
+import numpy as np
+
+from typing import List, Sequence, Tuple, Union
+
+__all__ = ["RingsSkyMap", "hsc_skymap", "find_tract"]
+
+# Overlap of neighbouring tracts, in degrees
+tract_overlap = 1.0 / 60
+# Size of the inner region of a patch, in arcseconds (4000 pixels of 0.168")
+patch_size = 4000 * 0.168
+
+
+class RingsSkyMap:
+    """
+    Sky map made of declination rings.
+
+    Parameters
+    ----------
+    num_rings
+        Number of rings, not counting the polar caps.
+    ra_start
+        RA of the center of the first tract of each ring, in degrees.
+    """
+    def __init__(self, num_rings: int = 120, ra_start: float = 0.0):
+        self.num_rings = num_rings
+        self.ra_start = math.radians(ra_start)
+        # Height of a ring, in radians
+        self.ring_size = math.pi / (num_rings + 1)
+        # Number of tracts in each ring
+        self.ring_nums: List[int] = []
+        for i in range(num_rings):
+            start_dec = self.ring_size * (i + 0.5) - 0.5 * math.pi
+            stop_dec = start_dec + self.ring_size
+            dec = min(abs(start_dec), abs(stop_dec))
+            self.ring_nums.append(int(2 * math.pi * math.cos(dec) / self.ring_size) + 1)
+        # Tract number of the first tract of each ring (tract 0 is the south polar cap)
+        self._ring_offsets = np.concatenate([[1], 1 + np.cumsum(self.ring_nums)])
+        self.num_tracts = sum(self.ring_nums) + 2
+
+    def find_tracts(self, ra: Union[float, Sequence[float]], dec: Union[float, Sequence[float]]) -> np.ndarray:
+        """
+        Find the tracts of positions.
+
+        Parameters
+        ----------
+        ra, dec
+            Positions, in degrees.
+
+        Returns
+        -------
+        tracts
+            Tract numbers.
+        """
+        ra = np.radians(np.asarray(ra, dtype=float))
+        dec = np.radians(np.asarray(dec, dtype=float))
+
+        first_ring_start = self.ring_size * 0.5 - 0.5 * math.pi
+        ring = np.floor((dec - first_ring_start) / self.ring_size).astype(int)
+        south = ring < 0
+        north = ring >= self.num_rings
+        ring = np.clip(ring, 0, self.num_rings - 1)
+
+        ring_nums = np.asarray(self.ring_nums)[ring]
+        ra_size = 2 * math.pi / ring_nums
+        tract_in_ring = np.floor(np.mod(ra - self.ra_start + 0.5 * ra_size, 2 * math.pi) / ra_size).astype(int)
+        tract_in_ring = np.mod(tract_in_ring, ring_nums)
+
+        tracts = self._ring_offsets[ring] + tract_in_ring
+        tracts = np.where(south, 0, tracts)
+        tracts = np.where(north, self.num_tracts - 1, tracts)
+        return tracts
+
+    def find_tract(self, ra: float, dec: float) -> int:
+        """
+        Find the tract of a position.
+
+        Parameters
+        ----------
+        ra, dec
+            Position, in degrees.
+
+        Returns
+        -------
+        tract
+            Tract number.
+        """
+        return int(self.find_tracts(ra, dec))
+
+    def find_overlapping_tracts(self, ra: float, dec: float, overlap: float = tract_overlap) -> List[int]:
+        """
+        Find all the tracts containing a position, counting their overlaps.
+
+        The overlap is approximated by widening the cell of every tract
+        by `overlap` on each side, whereas the real tracts are somewhat larger
+        since their pixel grid is made of whole patches.
+
+        Parameters
+        ----------
+        ra, dec
+            Position, in degrees.
+        overlap
+            Width of the margin added to the cell of a tract, in degrees.
+
+        Returns
+        -------
+        tracts
+            Tract numbers, that of `find_tract(ra, dec)` first.
+        """
+        ra_overlap = overlap / max(math.cos(math.radians(dec)), 1e-6)
+        tracts = [self.find_tract(ra, dec)]
+        for d_dec in (-overlap, 0.0, overlap):
+            for d_ra in (-ra_overlap, 0.0, ra_overlap):
+                tract = self.find_tract(ra + d_ra, max(-90.0, min(90.0, dec + d_dec)))
+                if tract not in tracts:
+                    tracts.append(tract)
+        return tracts
+
+    def ring_indices(self, tract: int) -> Tuple[int, int]:
+        """
+        Get the ring of a tract and its position in the ring.
+
+        Returns
+        -------
+        ring
+            Ring number: -1 for the south polar cap, `num_rings` for the north one.
+        index
+            Position of the tract in the ring (0 for the polar caps).
+        """
+        if not 0 <= tract < self.num_tracts:
+            raise IndexError(f"Tract out of range: {tract}")
+        if tract == 0:
+            return -1, 0
+        if tract == self.num_tracts - 1:
+            return self.num_rings, 0
+        ring = int(np.searchsorted(self._ring_offsets, tract, side="right")) - 1
+        return ring, tract - int(self._ring_offsets[ring])
+
+    def tract_center(self, tract: int) -> Tuple[float, float]:
+        """
+        Get the center of a tract.
+
+        Returns
+        -------
+        ra, dec
+            Center of the tract, in degrees.
+        """
+        ring, index = self.ring_indices(tract)
+        if ring == -1:
+            return 0.0, -90.0
+        if ring == self.num_rings:
+            return 0.0, 90.0
+        dec = self.ring_size * (ring + 1) - 0.5 * math.pi
+        ra = math.fmod(2 * math.pi * index / self.ring_nums[ring] + self.ra_start, 2 * math.pi)
+        return math.degrees(ra), math.degrees(dec)
+
+
+hsc_skymap = RingsSkyMap()
+
+
+def find_tract(ra: float, dec: float) -> int:
+    """
+    Find the HSC-SSP tract of a position.
+
+    Parameters
+    ----------
+    ra, dec
+        Position, in degrees.
+
+    Returns
+    -------
+    tract
+        Tract number.
+    """
+    return hsc_skymap.find_tract(ra, dec)
@@ -26,6 +26,16 @@ class BandSampler:
         samples['rms'] = np.maximum(samples['rms'], 1e-6)
         return samples
 
+    def max_seeing(self, nsigma=5):
+        """
+        Seeing that the samples almost never exceed: the largest mean plus
+        `nsigma` standard deviations of the seeing of the components of the mixture.
+        """
+        i = self.gmm_labels.index('seeing')
+        means = self.gmm_sampler.means_[:, i]
+        sigmas = np.sqrt(self.gmm_sampler.covariances_[:, i, i])
+        return float(np.max(means + nsigma * sigmas))
+
 
 def dp0_gmm_sampler(dp0_coadd="1"):
     if dp0_coadd == "single_visit":
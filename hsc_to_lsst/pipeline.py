@@ -1,8 +1,11 @@
-from hsc_to_lsst.hsc_query import query_hsc
+from hsc_to_lsst.hsc_query import query_hsc, query_hsc_batch, iter_query_hsc_batch
 from hsc_to_lsst.data_degradation.zero_point import zero_point_change
-from hsc_to_lsst.data_degradation.hsc_degradation import hsc_to_lsst
+from hsc_to_lsst.data_degradation.hsc_degradation import min_hsc_size
+from hsc_to_lsst.data_degradation.plan import get_plan
+from hsc_to_lsst.utils import planes_background, background_iterative, multiband_background
 from astropy.wcs import WCS
 from astropy.io import fits
+import numpy as np
 import warnings
 # import tarfile
 
@@ -15,6 +18,47 @@ HSC_FWHM = {
     'y': 0.53
 }
 
+# bit of the DETECTED plane of HSC masks, if not in the header
+HSC_DETECTED_BIT = 5
+
+# detect the sources of an object once, on its five bands together (see `utils.multiband_background`),
+# for `degrade_hsc_data`
+default_multiband_detection = False
+
+
+def sample_conditions(dp0_sampler):
+    """
+    Sample the DP0 observing conditions of the five bands of an object.
+    """
+    return [dp0_sampler[band].sample() for band in 'grizy']
+
+
+def min_hsc_size_arcsec(lsst_size_pix, dp0_stats_list, hsc_pix_scale=0.168, margin_arcsec=0.5):
+    """
+    Smallest HSC cutout, in arcsec, from which `degrade_hsc_data` makes
+    `lsst_size_pix` images for all the sampled conditions (see `sample_conditions`)
+    of all the objects.
+    The PSF-matching kernel is that of the nominal `HSC_FWHM`.
+    """
+    return max(min_hsc_size(lsst_size_pix,
+                            band,
+                            hsc_fwhm=HSC_FWHM[band],
+                            hsc_pix_scale=hsc_pix_scale,
+                            lsst_fwhm=dp0_stats[b]['seeing'],
+                            margin=margin_arcsec)
+               for dp0_stats in dp0_stats_list for b, band in enumerate('grizy'))
+
+
+def hsc_size_arcsec_for(lsst_size_pix, dp0_sampler, dp0_stats_list, hsc_pix_scale=0.168, margin_arcsec=0.5):
+    """
+    Width, in arcsec, of the HSC cutouts of objects degraded to the conditions `dp0_stats_list`:
+    that needed for the worst seeing of each band of `dp0_sampler` (see `BandSampler.max_seeing`),
+    the same for all the objects and runs so that the cutouts are found in the cache,
+    or more for the rare conditions that need more (see `min_hsc_size_arcsec`).
+    """
+    worst_stats = [{'seeing': dp0_sampler[band].max_seeing()} for band in 'grizy']
+    return min_hsc_size_arcsec(lsst_size_pix, [worst_stats] + list(dp0_stats_list), hsc_pix_scale, margin_arcsec)
+
 
 def query_and_degrade(
         ra,
@@ -24,33 +68,155 @@ def query_and_degrade(
         username=None,
         password=None,
         zp_rms_frac_thresh=0.3,
-        hsc_size_arcsec=20,
+        hsc_size_arcsec=None,
         lsst_size_pix=61,
         field="pdr3_wide",
-        verbose=False
+        verbose=False,
+        cache=None,
+        local_coadd=None,
+        use_psf=False,
+        psf_cache=None,
+        use_planes=False
 ):
+    """
+    Query an object and degrade it to LSST conditions sampled from `dp0_sampler`.
+    If `hsc_size_arcsec` is None, the cutout is that needed for the worst conditions
+    of `dp0_sampler` (see `hsc_size_arcsec_for`).
+    If `use_planes`, the background of the HSC images is measured
+    on their variance and mask planes, downloaded with them.
+    """
+    dp0_stats = sample_conditions(dp0_sampler)
+    if hsc_size_arcsec is None:
+        hsc_size_arcsec = hsc_size_arcsec_for(lsst_size_pix, dp0_sampler, [dp0_stats])
     try:
-        hsc_data = query_hsc(ra, dec, semaphore, username, password, hsc_size_arcsec, field)
+        hsc_data = query_hsc(ra, dec, semaphore, username, password, hsc_size_arcsec, field, cache,
+                             local_coadd, use_psf, psf_cache, use_planes)
     # this needs to keep going regardless of the error (common: OSError and tarfile.ReadError)
     except Exception as e:
         if verbose:
             print(f"Error querying HSC data: {type(e)} {e}")
         return False, None, None
+    return degrade_hsc_data(hsc_data, dp0_sampler, zp_rms_frac_thresh, lsst_size_pix, verbose, dp0_stats)
+
+
+def query_and_degrade_batch(
+        ra,
+        dec,
+        dp0_sampler,
+        semaphore,
+        username=None,
+        password=None,
+        zp_rms_frac_thresh=0.3,
+        hsc_size_arcsec=None,
+        lsst_size_pix=61,
+        field="pdr3_wide",
+        verbose=False,
+        cache=None,
+        local_coadd=None,
+        use_psf=False,
+        psf_cache=None,
+        merge_targets=False,
+        use_planes=False
+):
+    """
+    Same as `query_and_degrade` for several objects,
+    downloading all of them with a single query.
+    Returns a list of `(success, degraded_images, mag_change)`, one per object.
+    If `hsc_size_arcsec` is None, the cutouts are those needed for the worst conditions
+    of `dp0_sampler` (see `hsc_size_arcsec_for`).
+    """
+    dp0_stats_list = [sample_conditions(dp0_sampler) for _ in range(len(ra))]
+    if hsc_size_arcsec is None:
+        hsc_size_arcsec = hsc_size_arcsec_for(lsst_size_pix, dp0_sampler, dp0_stats_list)
+    try:
+        hsc_data_list = query_hsc_batch(ra, dec, semaphore, username, password, hsc_size_arcsec, field, cache,
+                                        local_coadd, use_psf, psf_cache, merge_targets, use_planes=use_planes)
+    # this needs to keep going regardless of the error (common: OSError and tarfile.ReadError)
+    except Exception as e:
+        if verbose:
+            print(f"Error querying HSC data: {type(e)} {e}")
+        return [(False, None, None) for _ in range(len(ra))]
+    return [degrade_hsc_data(hsc_data, dp0_sampler, zp_rms_frac_thresh, lsst_size_pix, verbose, dp0_stats)
+            for hsc_data, dp0_stats in zip(hsc_data_list, dp0_stats_list)]
+
+
+def _pix_scale(hdr):
+    # reading CD2_2 does not need the whole header to be parsed (see fits_decode.LazyHeader)
+    if 'CD2_2' in hdr:
+        return hdr['CD2_2'] * 3600
+    if hasattr(hdr, 'to_header'):
+        hdr = hdr.to_header()
+    return WCS(hdr).wcs.cd[1, 1] * 3600
+
+
+def _detected_bit(band_data):
+    mask_hdr = band_data.get('mask_hdr')
+    if mask_hdr is None:
+        return HSC_DETECTED_BIT
+    return int(mask_hdr.get('MP_DETECTED', HSC_DETECTED_BIT))
+
+
+def degrade_hsc_data(
+        hsc_data,
+        dp0_sampler,
+        zp_rms_frac_thresh=0.3,
+        lsst_size_pix=61,
+        verbose=False,
+        dp0_stats=None,
+        reuse_source_masks=True,
+        multiband_detection=None
+):
+    """
+    Degrade the five bands of an object to LSST conditions:
+    `dp0_stats` (see `sample_conditions`), or conditions sampled from `dp0_sampler` if None.
+    The background of the HSC images is measured on their variance and mask planes
+    if they are in `hsc_data`, and estimated from the images otherwise.
+    The sources are detected once per band, on the HSC image: their mask is resampled
+    to measure the background of the degraded image by sigma clipping (see `noise.add_noise`),
+    unless `reuse_source_masks` is False, then they are detected again on the degraded image.
+    With `multiband_detection` (`default_multiband_detection` if None), the sources are detected
+    on the chi-square image of the five bands, and their mask is shared by all the bands.
+    """
     for band in 'grizy':
         if not hsc_data[band]:
             if verbose:
                 print(f"Error querying HSC data: missing band {band}")
             return False, None, None
 
-    pix_scale = WCS(hsc_data['g']['hdr']).wcs.cd[1, 1] * 3600
+    pix_scale = _pix_scale(hsc_data['g']['hdr'])
 
     images = []
-    # psfs = []  # TODO: include psf when available
-    dp0_stats = []
+    psfs = []
     for band in 'grizy':
         images.append(hsc_data[band]['image'])
-        # psfs.append(hsc_data[band]['psf'])  # TODO: include psf when available
-        dp0_stats.append(dp0_sampler[band].sample())
+        # None if the PSF was not queried, then HSC_FWHM is used
+        psfs.append(hsc_data[band].get('psf'))
+    if dp0_stats is None:
+        dp0_stats = sample_conditions(dp0_sampler)
+
+    if multiband_detection is None:
+        multiband_detection = default_multiband_detection
+    original_rms = None
+    source_masks = [None] * 5
+    if all('variance' in hsc_data[band] and 'mask' in hsc_data[band] for band in 'grizy'):
+        original_rms = []
+        for b, band in enumerate('grizy'):
+            _, rms, source_masks[b] = planes_background(images[b],
+                                                        hsc_data[band]['variance'],
+                                                        hsc_data[band]['mask'],
+                                                        _detected_bit(hsc_data[band]))
+            original_rms.append(rms)
+    elif reuse_source_masks and multiband_detection and len({img.shape for img in images}) == 1:
+        _, original_rms, mask = multiband_background(images)
+        if not mask.all():
+            source_masks = [mask] * 5
+    elif reuse_source_masks:
+        if len({img.shape for img in images}) == 1:
+            # the five bands at once (see `utils.default_background_method`)
+            _, original_rms, source_masks = background_iterative(np.stack(images))
+        else:
+            original_rms, source_masks = zip(*[background_iterative(img)[1:] for img in images])
+        source_masks = [None if mask.all() else mask for mask in source_masks]
 
     # change zero points
     dp0_rms = [dp0_stats[b]['rms'] for b in range(5)]
@@ -59,7 +225,8 @@ def query_and_degrade(
                                            27,
                                            dp0_zero_points,
                                            dp0_rms,
-                                           rms_frac_thresh=zp_rms_frac_thresh)
+                                           rms_frac_thresh=zp_rms_frac_thresh,
+                                           original_rms=original_rms)
 
     degraded_images = []
     success = True
@@ -67,23 +234,21 @@ def query_and_degrade(
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             try:
-                deg_img_b = hsc_to_lsst(images[b],
-                                        band,
-                                        exp_time=dp0_stats[b]['exp_time'],
-                                        lsst_zero_point=dp0_stats[b]['zero_point'],
-                                        hsc_fwhm=HSC_FWHM[band],
-                                        # hsc_psf=psfs[b],  # TODO: include psf when available
-                                        hsc_pix_scale=pix_scale,
-                                        lsst_fwhm=dp0_stats[b]['seeing'],
-                                        background_noise=dp0_stats[b]['rms'],
-                                        background_median=dp0_stats[b]['median'],
-                                        psf_transform=True,
-                                        add_poisson_noise=True,
-                                        add_background_noise=True,
-                                        use_nise_diff=True,
-                                        to_adu=False,
-                                        out_size=lsst_size_pix
-                                        )
+                # same as `hsc_to_lsst`, with the plan of the band and shape built only once
+                plan = get_plan(band,
+                                images[b].shape,
+                                lsst_size_pix,
+                                hsc_fwhm=HSC_FWHM[band],
+                                hsc_pix_scale=pix_scale,
+                                psf_transform=True,
+                                add_poisson_noise=True,
+                                add_background_noise=True,
+                                use_nise_diff=True,
+                                to_adu=False)
+                deg_img_b = plan.apply(images[b],
+                                       dp0_stats[b],
+                                       hsc_psf=psfs[b],
+                                       source_mask=source_masks[b])
             # this needs to keep going regardless of the error (common: ValueError)
             except Exception as e:
                 if verbose:
@@ -112,10 +277,15 @@ def query_degrade_write(
         username=None,
         password=None,
         zp_rms_frac_thresh=0.3,
-        hsc_size_arcsec=20,
+        hsc_size_arcsec=None,
         lsst_size_pix=61,
         field="pdr3_wide",
-        verbose=False
+        verbose=False,
+        cache=None,
+        local_coadd=None,
+        use_psf=False,
+        psf_cache=None,
+        use_planes=False
 ):
     success, degraded_images, mag_change = query_and_degrade(
         ra,
@@ -128,7 +298,12 @@ def query_degrade_write(
         hsc_size_arcsec,
         lsst_size_pix,
         field,
-        verbose
+        verbose,
+        cache,
+        local_coadd,
+        use_psf,
+        psf_cache,
+        use_planes
     )
     if success:
         write_degraded_image(
@@ -136,3 +311,107 @@ def query_degrade_write(
             degraded_images,
         )
     return success, mag_change
+
+
+def query_degrade_write_batch(
+        out_filenames,
+        ra,
+        dec,
+        dp0_sampler,
+        semaphore,
+        username=None,
+        password=None,
+        zp_rms_frac_thresh=0.3,
+        hsc_size_arcsec=None,
+        lsst_size_pix=61,
+        field="pdr3_wide",
+        verbose=False,
+        cache=None,
+        local_coadd=None,
+        use_psf=False,
+        psf_cache=None,
+        merge_targets=False,
+        use_planes=False
+):
+    results = query_and_degrade_batch(
+        ra,
+        dec,
+        dp0_sampler,
+        semaphore,
+        username,
+        password,
+        zp_rms_frac_thresh,
+        hsc_size_arcsec,
+        lsst_size_pix,
+        field,
+        verbose,
+        cache,
+        local_coadd,
+        use_psf,
+        psf_cache,
+        merge_targets,
+        use_planes
+    )
+    out = []
+    for out_filename, (success, degraded_images, mag_change) in zip(out_filenames, results):
+        if success:
+            write_degraded_image(
+                out_filename,
+                degraded_images,
+            )
+        out.append((success, mag_change))
+    return out
+
+
+def query_degrade_write_stream(
+        out_filenames,
+        ra,
+        dec,
+        dp0_sampler,
+        semaphore,
+        username=None,
+        password=None,
+        zp_rms_frac_thresh=0.3,
+        hsc_size_arcsec=None,
+        lsst_size_pix=61,
+        field="pdr3_wide",
+        verbose=False,
+        cache=None,
+        local_coadd=None,
+        use_psf=False,
+        psf_cache=None,
+        merge_targets=False,
+        use_planes=False
+):
+    """
+    Same as `query_degrade_write_batch`, but each object is degraded and written
+    as soon as its five bands have been downloaded,
+    while the rest of the query is still being received.
+    """
+    out = [(False, None) for _ in range(len(ra))]
+    dp0_stats_list = [sample_conditions(dp0_sampler) for _ in range(len(ra))]
+    if hsc_size_arcsec is None:
+        hsc_size_arcsec = hsc_size_arcsec_for(lsst_size_pix, dp0_sampler, dp0_stats_list)
+    try:
+        for i, hsc_data in iter_query_hsc_batch(ra, dec, semaphore, username, password, hsc_size_arcsec, field,
+                                                cache, local_coadd, use_psf, psf_cache, merge_targets,
+                                                use_planes=use_planes):
+            success, degraded_images, mag_change = degrade_hsc_data(
+                hsc_data,
+                dp0_sampler,
+                zp_rms_frac_thresh,
+                lsst_size_pix,
+                verbose,
+                dp0_stats_list[i]
+            )
+            if success:
+                write_degraded_image(
+                    out_filenames[i],
+                    degraded_images,
+                )
+            out[i] = (success, mag_change)
+    # this needs to keep going regardless of the error (common: OSError and tarfile.ReadError)
+    except Exception as e:
+        if verbose:
+            print(f"Error querying HSC data: {type(e)} {e}")
+    return out
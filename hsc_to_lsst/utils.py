@@ -4,6 +4,11 @@ from photutils.utils import circular_footprint
 import warnings
 import numpy as np
 from scipy.interpolate import UnivariateSpline
+from scipy.stats import chi2, norm
+from scipy import ndimage
+
+# "photutils" (`photutils_background_iterative`) or "fast" (`fast_background`), for `background_iterative`
+default_background_method = "photutils"
 
 
 def photutils_background_iterative(
@@ -36,6 +41,158 @@ def photutils_background_iterative(
     return median, std, mask
 
 
+def _clipped_stats(data, valid, sigma_clip, clip_iters):
+    # median and std of each image of a stack, as `sigma_clipped_stats` of its `valid` pixels;
+    # the pixels kept by the clipping are a range of the sorted values, whose sums come from cumulative sums
+    flat = data.reshape(len(data), -1)
+    values = np.sort(np.where(valid.reshape(len(data), -1), flat, np.inf), axis=1)
+    rows = np.arange(len(data))
+    lo = np.zeros(len(data), dtype=int)
+    hi = np.isfinite(values).sum(axis=1)
+    # centered on a rough median, for the precision of the sums of squares;
+    # the sums up to `hi` do not reach the infinite values
+    center = values[rows, np.maximum(hi - 1, 0) // 2]
+    values_centered = values - np.where(np.isfinite(center), center, 0)[:, None]
+    sums = np.zeros((len(data), values.shape[1] + 1))
+    np.cumsum(values_centered, axis=1, out=sums[:, 1:])
+    squares = np.zeros_like(sums)
+    np.cumsum(values_centered**2, axis=1, out=squares[:, 1:])
+    for i in range(clip_iters + 1):
+        n = hi - lo
+        with np.errstate(invalid="ignore", divide="ignore"):
+            median = np.where(n > 0, (values[rows, lo + np.maximum(n - 1, 0) // 2]
+                                      + values[rows, np.minimum(lo + n // 2, values.shape[1] - 1)]) / 2, np.nan)
+            mean = (sums[rows, hi] - sums[rows, lo]) / n
+            std = np.sqrt(np.maximum((squares[rows, hi] - squares[rows, lo]) / n - mean**2, 0))
+        if i == clip_iters:
+            break
+        lower = median - sigma_clip * std
+        upper = median + sigma_clip * std
+        new_lo = np.maximum(lo, [np.searchsorted(v, b, side="left") for v, b in zip(values, lower)])
+        new_hi = np.minimum(hi, [np.searchsorted(v, b, side="right") for v, b in zip(values, upper)])
+        if (new_lo == lo).all() and (new_hi == hi).all():
+            break
+        lo, hi = new_lo, new_hi
+    return median, std
+
+
+def fast_background(
+        data,
+        nsigma_detection=3,
+        sigma_clip=3,
+        clip_iters=10,
+        npixels_detection=5,
+        init_median=0,
+        init_rms=None,
+        mask_size=2,
+        iters=3
+):
+    # same as `photutils_background_iterative`, for an image or a whole (N, H, W) stack at once:
+    # vectorized sigma clipping, and `scipy.ndimage` labelling (8-connected) and dilation
+    # for the source masks; the medians and rms are arrays for a stack
+    data = np.asarray(data, dtype=float)
+    single = data.ndim == 2
+    if single:
+        data = data[None]
+    finite = np.isfinite(data)
+    median = np.full(len(data), float(init_median))
+    if init_rms is None:
+        std = _clipped_stats(data, finite, sigma_clip, clip_iters)[1]
+    else:
+        std = np.full(len(data), float(init_rms))
+    mask = np.zeros(data.shape, dtype=bool)
+    # labelling and dilation within each image of the stack
+    connectivity = np.zeros((3, 3, 3), dtype=bool)
+    connectivity[1] = True
+    footprint = circular_footprint(radius=mask_size)[None].astype(bool)
+    active = np.ones(len(data), dtype=bool)
+    for i in range(iters):
+        threshold = median + nsigma_detection * std
+        labels, _ = ndimage.label(data > threshold[:, None, None], structure=connectivity)
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        sources = (sizes >= npixels_detection)[labels]
+        new_mask = ndimage.binary_dilation(sources, structure=footprint)
+        # as `photutils_background_iterative`, an image stops at no source or no background
+        detected = active & sources.any(axis=(1, 2))
+        mask[detected] = new_mask[detected]
+        active = detected & ~new_mask.all(axis=(1, 2))
+        if not active.any():
+            break
+        new_median, new_std = _clipped_stats(data[active], finite[active] & ~mask[active], sigma_clip, clip_iters)
+        median[active] = new_median
+        std[active] = new_std
+    if single:
+        return median[0], std[0], mask[0]
+    return median, std, mask
+
+
+def background_iterative(data, background_method=None, **kwargs):
+    # background of an image, or of a (N, H, W) stack, by `background_method`
+    # (`default_background_method` if None): median, rms and source mask
+    if background_method is None:
+        background_method = default_background_method
+    if background_method == "fast":
+        return fast_background(data, **kwargs)
+    if background_method != "photutils":
+        raise ValueError(f"Unknown background method: {background_method}")
+    if np.ndim(data) == 2:
+        return photutils_background_iterative(data, **kwargs)
+    medians, stds, masks = zip(*[photutils_background_iterative(img, **kwargs) for img in data])
+    return np.array(medians), np.array(stds), np.array(masks)
+
+
+def multiband_background(
+        images,
+        nsigma_detection=3,
+        sigma_clip=3,
+        clip_iters=10,
+        npixels_detection=5,
+        mask_size=2,
+        iters=3
+):
+    # same as `photutils_background_iterative` for images of the same shape (the bands of an object),
+    # with a single source mask detected on their chi-square image:
+    # the sum of the squared S/N of the bands, thresholded at the same false-positive rate
+    # as `nsigma_detection` in a single band
+    images = np.asarray(images, dtype=float)
+    medians = np.zeros(len(images))
+    stds = np.array([sigma_clipped_stats(img, sigma=sigma_clip, maxiters=clip_iters)[-1] for img in images])
+    mask = np.zeros(images.shape[1:], dtype=bool)
+    threshold = chi2.isf(norm.sf(nsigma_detection), df=len(images))
+    footprint = circular_footprint(radius=mask_size)
+    for i in range(iters):
+        chi2_img = np.sum(((images - medians[:, None, None]) / stds[:, None, None])**2, axis=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            segment_img = detect_sources(chi2_img, threshold, npixels=npixels_detection)
+        if segment_img is None:
+            break
+        mask = segment_img.make_source_mask(footprint=footprint)
+        if np.all(mask):
+            break
+        for b, img in enumerate(images):
+            _, medians[b], stds[b] = sigma_clipped_stats(img, sigma=sigma_clip, mask=mask, maxiters=clip_iters)
+    return medians, stds, mask
+
+
+def planes_background(
+        data,
+        variance,
+        mask,
+        detected_bit=5
+):
+    # same output as `photutils_background_iterative`, from the variance and mask planes of an HSC image:
+    # the sources are the pixels with the DETECTED bit of the mask
+    mask = (mask & (1 << detected_bit)) != 0
+    good = ~mask & np.isfinite(data) & np.isfinite(variance)
+    if not np.any(good):
+        good = np.isfinite(data) & np.isfinite(variance)
+    median = np.median(data[good])
+    std = np.sqrt(np.median(variance[good]))
+    return median, std, mask
+
+
 def get_fwhm(psf, pix_scale):
     # Define the center of the PSF (assuming it's approximately centered)
     center_x = (psf.shape[1] - 1) // 2